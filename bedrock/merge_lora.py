@@ -0,0 +1,224 @@
+"""Merge a LoRA adapter into its base model one shard at a time.
+
+`merge_and_unload()` in PEFT needs the whole base model in RAM. This script
+instead memory-maps one base shard, adds the LoRA delta to the tensors that
+have one, and writes the shard back as safetensors, so peak memory per worker
+stays around one shard. Shards are processed in parallel worker processes and
+a `model.safetensors.index.json` is written for the result.
+
+    python merge_lora.py \\
+        --base deepseek-ai/deepseek-coder-6.7b-base \\
+        --adapter ./deepseek_model_finetuned \\
+        --output ./deepseek_finetuned_merged \\
+        --workers 4
+
+The adapter can be a PEFT directory (adapter_model.safetensors / .bin) or a
+DeepSpeed checkpoint directory like deepseek_model_finetuned, in which case
+the LoRA tensors are read from `<latest>/mp_rank_00_model_states.pt`.
+"""
+import argparse
+import json
+import math
+import os
+import re
+import resource
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+LORA_KEY = re.compile(r"^(?:base_model\.model\.)?(.+)\.lora_([AB])(?:\.[^.]+)?\.weight$")
+WEIGHT_SUFFIXES = (".safetensors", ".bin", ".pt", ".pth", ".ckpt")
+TOKENIZER_FILES = ("special_tokens_map.json", "tokenizer_config.json", "tokenizer.json", "tokenizer.model")
+INDEX_NAME = "model.safetensors.index.json"
+
+
+def _pattern_value(patterns: dict, module: str, default):
+    # same matching rule as PEFT's rank_pattern / alpha_pattern
+    for pattern, value in patterns.items():
+        if module == pattern or re.match(rf"(.*\.)?{pattern}$", module):
+            return value
+    return default
+
+
+def _read_adapter_state(adapter_dir: str):
+    for name in ("adapter_model.safetensors", "adapter_model.bin"):
+        path = os.path.join(adapter_dir, name)
+        if os.path.exists(path):
+            if name.endswith(".safetensors"):
+                return load_file(path)
+            return torch.load(path, map_location="cpu", weights_only=True)
+
+    latest = os.path.join(adapter_dir, "latest")
+    if os.path.exists(latest):
+        with open(latest) as f:
+            step_dir = os.path.join(adapter_dir, f.read().strip())
+        path = os.path.join(step_dir, "mp_rank_00_model_states.pt")
+        # DeepSpeed keeps the whole module here (frozen base weights included);
+        # mmap it and copy out only the LoRA tensors
+        checkpoint = torch.load(path, map_location="cpu", mmap=True, weights_only=False)
+        return {key: value.clone() for key, value in checkpoint["module"].items() if ".lora_" in key}
+
+    raise FileNotFoundError(f"No adapter_model.* or DeepSpeed checkpoint found in {adapter_dir}")
+
+
+def load_lora(adapter_dir: str):
+    """Return {base weight name: (A, B, scale)} for every LoRA target in the adapter."""
+    with open(os.path.join(adapter_dir, "adapter_config.json")) as f:
+        config = json.load(f)
+    if config.get("peft_type", "LORA") != "LORA":
+        raise ValueError(f"Unsupported peft_type {config['peft_type']}")
+    if config.get("use_dora"):
+        raise ValueError("DoRA adapters cannot be merged by adding B @ A")
+
+    pairs = {}
+    for key, tensor in _read_adapter_state(adapter_dir).items():
+        match = LORA_KEY.match(key)
+        if match is None:
+            raise ValueError(f"Unsupported adapter tensor {key}")
+        module, which = match.groups()
+        pairs.setdefault(module, {})[which] = tensor
+
+    lora = {}
+    for module, pair in pairs.items():
+        if set(pair) != {"A", "B"}:
+            raise ValueError(f"Incomplete LoRA pair for {module}")
+        r = _pattern_value(config.get("rank_pattern") or {}, module, config["r"])
+        alpha = _pattern_value(config.get("alpha_pattern") or {}, module, config["lora_alpha"])
+        scale = alpha / math.sqrt(r) if config.get("use_rslora") else alpha / r
+        lora[f"{module}.weight"] = (pair["A"], pair["B"], scale)
+    return lora, bool(config.get("fan_in_fan_out"))
+
+
+def merge_tensor(weight: torch.Tensor, a: torch.Tensor, b: torch.Tensor, scale: float, fan_in_fan_out: bool = False):
+    delta = (b.float() @ a.float()) * scale
+    if fan_in_fan_out:
+        delta = delta.T
+    return (weight.float() + delta).to(weight.dtype)
+
+
+_lora = None
+_fan_in_fan_out = False
+
+
+def _init_worker(lora, fan_in_fan_out):
+    global _lora, _fan_in_fan_out
+    _lora = lora
+    _fan_in_fan_out = fan_in_fan_out
+
+
+def _iter_shard(path: str):
+    if path.endswith(".safetensors"):
+        with safe_open(path, framework="pt") as f:
+            for name in f.keys():
+                yield name, f.get_tensor(name)
+    else:
+        state_dict = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        for name, tensor in state_dict.items():
+            # a private copy, tied weights would otherwise share storage in save_file
+            yield name, tensor.clone()
+
+
+def merge_shard(base_path: str, output_path: str):
+    tensors = {}
+    merged = []
+    for name, tensor in _iter_shard(base_path):
+        if name in _lora:
+            a, b, scale = _lora[name]
+            tensor = merge_tensor(tensor, a, b, scale, _fan_in_fan_out)
+            merged.append(name)
+        tensors[name] = tensor.contiguous()
+    save_file(tensors, output_path, metadata={"format": "pt"})
+    total_size = sum(t.numel() * t.element_size() for t in tensors.values())
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return list(tensors), merged, total_size, peak_rss_mb
+
+
+def find_base_shards(base_dir: str):
+    for index_name, suffix in ((INDEX_NAME, ".safetensors"), ("pytorch_model.bin.index.json", ".bin")):
+        index_path = os.path.join(base_dir, index_name)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                weight_map = json.load(f)["weight_map"]
+            return [os.path.join(base_dir, name) for name in sorted(set(weight_map.values()))]
+    for name in ("model.safetensors", "pytorch_model.bin"):
+        if os.path.exists(os.path.join(base_dir, name)):
+            return [os.path.join(base_dir, name)]
+    raise FileNotFoundError(f"No model weights found in {base_dir}")
+
+
+def resolve_base(base: str):
+    if os.path.isdir(base):
+        return base
+    from huggingface_hub import list_repo_files, snapshot_download
+
+    ignore_patterns = ["*.pt", "*.pth", "*.ckpt", "*.msgpack", "*.h5"]
+    # find_base_shards reads safetensors first, don't download the .bin copy as well
+    repo_files = list_repo_files(base)
+    if INDEX_NAME in repo_files or "model.safetensors" in repo_files:
+        ignore_patterns.append("*.bin")
+    return snapshot_download(base, ignore_patterns=ignore_patterns)
+
+
+def merge_lora(base: str, adapter_dir: str, output_dir: str, workers: int = 1):
+    start = time.time()
+    base_dir = resolve_base(base)
+    shards = find_base_shards(base_dir)
+    lora, fan_in_fan_out = load_lora(adapter_dir)
+    print(f"Merging {len(lora)} LoRA weights into {len(shards)} shards with {workers} workers")
+
+    os.makedirs(output_dir, exist_ok=True)
+    output_names = [f"model-{i + 1:05d}-of-{len(shards):05d}.safetensors" for i in range(len(shards))]
+    if len(shards) == 1:
+        output_names = ["model.safetensors"]
+
+    weight_map = {}
+    merged = set()
+    total_size = 0
+    peak_rss_mb = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(lora, fan_in_fan_out)) as executor:
+        results = executor.map(merge_shard, shards,
+                               [os.path.join(output_dir, name) for name in output_names])
+        for shard, name, (names, shard_merged, size, rss_mb) in zip(shards, output_names, results):
+            print(f"{os.path.basename(shard)} -> {name}: {len(shard_merged)} merged, peak RSS {rss_mb:.0f} MB")
+            weight_map.update({tensor_name: name for tensor_name in names})
+            merged.update(shard_merged)
+            total_size += size
+            peak_rss_mb = max(peak_rss_mb, rss_mb)
+
+    missing = sorted(set(lora) - merged)
+    if missing:
+        raise ValueError(f"LoRA weights without a base tensor: {missing[:5]}")
+
+    if len(output_names) > 1:
+        with open(os.path.join(output_dir, INDEX_NAME), "w") as f:
+            json.dump({"metadata": {"total_size": total_size}, "weight_map": weight_map}, f, indent=2)
+
+    # config / generation config from the base, tokenizer from the fine-tuned checkpoint
+    for name in os.listdir(base_dir):
+        path = os.path.join(base_dir, name)
+        if os.path.isfile(path) and not name.endswith(WEIGHT_SUFFIXES) and not name.endswith(".index.json"):
+            shutil.copy(path, os.path.join(output_dir, name))
+    for name in TOKENIZER_FILES:
+        path = os.path.join(adapter_dir, name)
+        if os.path.exists(path):
+            shutil.copy(path, os.path.join(output_dir, name))
+
+    print(f"Merged model written to {output_dir} in {time.time() - start:.1f}s, "
+          f"peak worker RSS {peak_rss_mb:.0f} MB")
+    return output_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge a LoRA adapter into sharded safetensors, one shard at a time")
+    parser.add_argument("--base", required=True, help="base model directory or Hugging Face model id")
+    parser.add_argument("--adapter", required=True, help="PEFT adapter or DeepSpeed checkpoint directory")
+    parser.add_argument("--output", required=True, help="output directory")
+    parser.add_argument("--workers", type=int, default=1, help="shards merged in parallel")
+    args = parser.parse_args()
+
+    merge_lora(args.base, args.adapter, args.output, args.workers)
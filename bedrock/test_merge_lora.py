@@ -0,0 +1,147 @@
+"""Tests for merge_lora.py on a tiny two-shard bf16 base.
+
+    pytest bedrock/test_merge_lora.py
+"""
+import json
+import math
+import os
+
+import pytest
+import torch
+from safetensors.torch import load_file, save_file
+
+from merge_lora import INDEX_NAME, merge_lora
+
+HIDDEN = 32
+SHARDS = {
+    "model-00001-of-00002.safetensors": ["model.embed_tokens.weight", "model.layers.0.self_attn.q_proj.weight",
+                                         "model.layers.0.self_attn.k_proj.weight"],
+    "model-00002-of-00002.safetensors": ["model.layers.0.self_attn.v_proj.weight", "model.norm.weight"],
+}
+
+
+@pytest.fixture
+def base_dir(tmp_path):
+    torch.manual_seed(0)
+    path = tmp_path / "base"
+    path.mkdir()
+    weight_map = {}
+    for shard, names in SHARDS.items():
+        tensors = {}
+        for name in names:
+            shape = (HIDDEN,) if name.endswith("norm.weight") else (HIDDEN, HIDDEN)
+            tensors[name] = torch.randn(shape).to(torch.bfloat16)
+            weight_map[name] = shard
+        save_file(tensors, str(path / shard), metadata={"format": "pt"})
+    with open(path / INDEX_NAME, "w") as f:
+        json.dump({"metadata": {"total_size": 0}, "weight_map": weight_map}, f)
+    with open(path / "config.json", "w") as f:
+        json.dump({"model_type": "llama"}, f)
+    return path
+
+
+def base_tensors(base_dir):
+    tensors = {}
+    for shard in SHARDS:
+        tensors.update(load_file(str(base_dir / shard)))
+    return tensors
+
+
+def lora_pair(rank):
+    return torch.randn(rank, HIDDEN), torch.randn(HIDDEN, rank) * 0.1
+
+
+def write_config(adapter_dir, **config):
+    config = {"peft_type": "LORA", "r": 4, "lora_alpha": 8, **config}
+    with open(adapter_dir / "adapter_config.json", "w") as f:
+        json.dump(config, f)
+
+
+def reference(weight, a, b, scale):
+    return (weight.double() + scale * (b.double() @ a.double())).to(torch.bfloat16)
+
+
+def assert_merged(actual, expected):
+    # the merge accumulates in float32, allow one bf16 ulp against the float64 reference
+    torch.testing.assert_close(actual.double(), expected.double(), rtol=2 ** -8, atol=0)
+    assert actual.dtype == torch.bfloat16
+
+
+def read_output(output_dir):
+    with open(output_dir / INDEX_NAME) as f:
+        weight_map = json.load(f)["weight_map"]
+    tensors = {}
+    for shard in set(weight_map.values()):
+        tensors.update(load_file(str(output_dir / shard)))
+    return weight_map, tensors
+
+
+@pytest.mark.parametrize("use_rslora", [False, True])
+def test_peft_adapter(base_dir, tmp_path, use_rslora):
+    adapter_dir = tmp_path / "adapter"
+    adapter_dir.mkdir()
+    # q_proj lives in the first shard, v_proj in the second with its own rank and alpha
+    q_a, q_b = lora_pair(4)
+    v_a, v_b = lora_pair(2)
+    save_file({
+        "base_model.model.model.layers.0.self_attn.q_proj.lora_A.weight": q_a,
+        "base_model.model.model.layers.0.self_attn.q_proj.lora_B.weight": q_b,
+        "base_model.model.model.layers.0.self_attn.v_proj.lora_A.weight": v_a,
+        "base_model.model.model.layers.0.self_attn.v_proj.lora_B.weight": v_b,
+    }, str(adapter_dir / "adapter_model.safetensors"))
+    write_config(adapter_dir, rank_pattern={"v_proj": 2}, alpha_pattern={"v_proj": 16}, use_rslora=use_rslora)
+
+    output_dir = tmp_path / "merged"
+    merge_lora(str(base_dir), str(adapter_dir), str(output_dir))
+
+    base = base_tensors(base_dir)
+    weight_map, merged = read_output(output_dir)
+    assert weight_map == {name: shard for shard, names in SHARDS.items() for name in names}
+    assert sorted(os.listdir(output_dir)) == sorted([*SHARDS, INDEX_NAME, "config.json"])
+
+    q_scale = 8 / math.sqrt(4) if use_rslora else 8 / 4
+    v_scale = 16 / math.sqrt(2) if use_rslora else 16 / 2
+    assert_merged(merged["model.layers.0.self_attn.q_proj.weight"],
+                  reference(base["model.layers.0.self_attn.q_proj.weight"], q_a, q_b, q_scale))
+    assert_merged(merged["model.layers.0.self_attn.v_proj.weight"],
+                  reference(base["model.layers.0.self_attn.v_proj.weight"], v_a, v_b, v_scale))
+    for name in ("model.embed_tokens.weight", "model.layers.0.self_attn.k_proj.weight", "model.norm.weight"):
+        assert torch.equal(merged[name], base[name])
+
+
+def test_deepspeed_checkpoint(base_dir, tmp_path):
+    adapter_dir = tmp_path / "checkpoint"
+    (adapter_dir / "global_step10").mkdir(parents=True)
+    (adapter_dir / "latest").write_text("global_step10\n")
+    base = base_tensors(base_dir)
+    k_a, k_b = lora_pair(4)
+    # the module state keeps the frozen base weights next to the LoRA pairs
+    torch.save({"module": {
+        "base_model.model.model.layers.0.self_attn.k_proj.base_layer.weight": base["model.layers.0.self_attn.k_proj.weight"],
+        "base_model.model.model.layers.0.self_attn.k_proj.lora_A.default.weight": k_a,
+        "base_model.model.model.layers.0.self_attn.k_proj.lora_B.default.weight": k_b,
+    }}, adapter_dir / "global_step10" / "mp_rank_00_model_states.pt")
+    write_config(adapter_dir)
+
+    output_dir = tmp_path / "merged"
+    merge_lora(str(base_dir), str(adapter_dir), str(output_dir))
+
+    _, merged = read_output(output_dir)
+    assert_merged(merged["model.layers.0.self_attn.k_proj.weight"],
+                  reference(base["model.layers.0.self_attn.k_proj.weight"], k_a, k_b, 8 / 4))
+    for name in ("model.layers.0.self_attn.q_proj.weight", "model.layers.0.self_attn.v_proj.weight"):
+        assert torch.equal(merged[name], base[name])
+
+
+def test_lora_without_base_tensor(base_dir, tmp_path):
+    adapter_dir = tmp_path / "adapter"
+    adapter_dir.mkdir()
+    a, b = lora_pair(4)
+    save_file({
+        "base_model.model.model.layers.1.self_attn.q_proj.lora_A.weight": a,
+        "base_model.model.model.layers.1.self_attn.q_proj.lora_B.weight": b,
+    }, str(adapter_dir / "adapter_model.safetensors"))
+    write_config(adapter_dir)
+
+    with pytest.raises(ValueError, match="LoRA weights without a base tensor"):
+        merge_lora(str(base_dir), str(adapter_dir), str(tmp_path / "merged"))
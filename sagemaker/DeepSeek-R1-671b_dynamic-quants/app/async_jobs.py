@@ -0,0 +1,476 @@
+"""Asynchronous inference jobs for the proxy.
+
+A request with an `input_location` instead of `messages`/`prompt` is queued as
+a job and answered with 202 right away. The job streams its input from S3 (JSON
+lines with one request per line, or a single JSON request), runs every request
+against the engine with `stream: true` and writes the output back with a
+multipart upload as tokens arrive, so neither the input nor the generated text
+is held in memory as a whole. Each output line has the shape of a non-streaming
+response. A notification is sent to SNS (or POSTed to an HTTP URL) when a job
+completes or fails.
+
+Jobs share the engine slots with real-time requests through CapacityGate:
+real-time requests go first and jobs never hold more than
+`ASYNC_MAX_CONCURRENCY` slots.
+
+S3 is accessed with boto3, so a local S3-compatible server (MinIO, moto) can
+stand in for S3 by setting `AWS_ENDPOINT_URL_S3`.
+"""
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import aiohttp
+import boto3
+
+JSONL_TYPES = ("application/jsonlines", "application/x-jsonlines", "application/jsonl")
+MIN_PART_SIZE = 5 * 1024 * 1024
+SAFE_KEY_NAME = re.compile(r"^[\w.-]{1,128}$")
+
+
+def parse_s3_uri(uri: str, prefix: bool = False):
+    """Return (bucket, key); with prefix=True the key may be empty (s3://bucket)."""
+    if not isinstance(uri, str) or not uri.startswith("s3://"):
+        raise ValueError(f"Not an S3 location: {uri!r}")
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    if not bucket or not (key or prefix):
+        raise ValueError(f"Not an S3 object location: {uri!r}")
+    return bucket, key
+
+
+def output_name(job_id: str):
+    """Output file name for a job id.
+
+    SageMaker InferenceIds may contain characters such as ':' or '/'; those are
+    replaced and a hash of the id is appended so different ids never share a key.
+    """
+    if SAFE_KEY_NAME.match(job_id) and not job_id.startswith("."):
+        return f"{job_id}.out"
+    name = re.sub(r"[^\w.-]", "_", job_id)[:100].lstrip(".")
+    digest = hashlib.sha256(job_id.encode("utf-8")).hexdigest()[:16]
+    return f"{name}-{digest}.out"
+
+
+def is_job(payload):
+    return isinstance(payload, dict) and "input_location" in payload \
+        and "messages" not in payload and "prompt" not in payload
+
+
+def _timestamp(seconds: float):
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat(timespec="milliseconds")
+
+
+class CapacityGate:
+    """Engine slots shared by real-time requests and background jobs.
+
+    Real-time requests take any free slot. A job record only starts when no
+    real-time request is waiting and fewer than `background_slots` slots are
+    held by jobs, so a burst of long generations cannot starve the endpoint.
+    """
+
+    def __init__(self, slots: int, background_slots: int):
+        self.slots = slots
+        self.background_slots = min(background_slots, slots)
+        self.in_use = 0
+        self.background_in_use = 0
+        self.realtime_waiting = 0
+        self._cond = asyncio.Condition()
+
+    async def _release(self, background: bool):
+        async with self._cond:
+            self.in_use -= 1
+            if background:
+                self.background_in_use -= 1
+            self._cond.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def realtime(self):
+        async with self._cond:
+            self.realtime_waiting += 1
+            try:
+                await self._cond.wait_for(lambda: self.in_use < self.slots)
+            finally:
+                self.realtime_waiting -= 1
+                # a cancelled real-time waiter may unblock a job
+                self._cond.notify_all()
+            self.in_use += 1
+        try:
+            yield
+        finally:
+            await self._release(False)
+
+    @contextlib.asynccontextmanager
+    async def background(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.realtime_waiting == 0 and self.in_use < self.slots
+                                      and self.background_in_use < self.background_slots)
+            self.in_use += 1
+            self.background_in_use += 1
+        try:
+            yield
+        finally:
+            await self._release(True)
+
+    def get_stats(self):
+        return {
+            "slots": self.slots,
+            "in_use": self.in_use,
+            "jobs_in_use": self.background_in_use,
+            "realtime_waiting": self.realtime_waiting,
+        }
+
+
+class MultipartWriter:
+    """Writes an S3 object in parts of `part_size` bytes as the data comes in."""
+
+    def __init__(self, s3, bucket: str, key: str, part_size: int, content_type: str = "application/jsonlines"):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.content_type = content_type
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.bytes_written = 0
+
+    async def _upload_part(self, data: bytes):
+        if self.upload_id is None:
+            response = await asyncio.to_thread(self.s3.create_multipart_upload, Bucket=self.bucket,
+                                               Key=self.key, ContentType=self.content_type)
+            self.upload_id = response["UploadId"]
+        number = len(self.parts) + 1
+        response = await asyncio.to_thread(self.s3.upload_part, Bucket=self.bucket, Key=self.key,
+                                           UploadId=self.upload_id, PartNumber=number, Body=data)
+        self.parts.append({"ETag": response["ETag"], "PartNumber": number})
+
+    async def write(self, data: bytes):
+        self.buffer += data
+        self.bytes_written += len(data)
+        if len(self.buffer) >= self.part_size:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            await self._upload_part(data)
+
+    async def close(self):
+        if self.upload_id is None:
+            # everything fits in one part, a plain PUT is enough
+            await asyncio.to_thread(self.s3.put_object, Bucket=self.bucket, Key=self.key,
+                                    Body=bytes(self.buffer), ContentType=self.content_type)
+        else:
+            if self.buffer:
+                await self._upload_part(bytes(self.buffer))
+            await asyncio.to_thread(self.s3.complete_multipart_upload, Bucket=self.bucket, Key=self.key,
+                                    UploadId=self.upload_id, MultipartUpload={"Parts": self.parts})
+        self.buffer.clear()
+
+    async def abort(self):
+        self.buffer.clear()
+        if self.upload_id is None:
+            return
+        try:
+            await asyncio.to_thread(self.s3.abort_multipart_upload, Bucket=self.bucket, Key=self.key,
+                                    UploadId=self.upload_id)
+        except Exception as e:
+            print(f"Error aborting upload of s3://{self.bucket}/{self.key}: {e}")
+
+
+class RecordWriter:
+    """Writes one output line while the response streams in.
+
+    The line has the shape of a non-streaming response; the text deltas are
+    appended to the open JSON string values instead of being collected first.
+    """
+
+    def __init__(self, out: MultipartWriter, index: int, chat: bool):
+        self.out = out
+        self.index = index
+        self.chat = chat
+        self.field = None
+
+    async def _write(self, text: str):
+        await self.out.write(text.encode("utf-8"))
+
+    async def start(self):
+        head = '{"index": %d, "choices": [{"index": 0' % self.index
+        if self.chat:
+            head += ', "message": {"role": "assistant"'
+        await self._write(head)
+
+    async def delta(self, field: str, text: str):
+        if field != self.field:
+            if self.field is not None:
+                await self._write('"')
+            await self._write(f', {json.dumps(field)}: "')
+            self.field = field
+        await self._write(json.dumps(text, ensure_ascii=False)[1:-1])
+
+    async def finish(self, finish_reason=None, usage=None, error=None):
+        if self.field is not None:
+            tail = '"'
+        else:
+            tail = '' if self.chat else ', "text": ""'
+        if self.chat:
+            tail += "}"
+        tail += f', "finish_reason": {json.dumps(finish_reason)}}}]'
+        if usage is not None:
+            tail += f', "usage": {json.dumps(usage)}'
+        if error is not None:
+            tail += f', "error": {json.dumps(error)}'
+        await self._write(tail + "}\n")
+
+
+class AsyncJobs:
+    def __init__(self, base_url: str, slots: int = 2, max_concurrency: int = 1, queue_size: int = 64,
+                 output_path: str = None, part_size: int = 8 * 1024 * 1024, success_topic: str = None,
+                 error_topic: str = None, read_timeout: float = 600, history: int = 1000):
+        self.base_url = base_url
+        self.gate = CapacityGate(slots, max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.queue = asyncio.Queue(queue_size)
+        self.output_path = output_path.rstrip("/") if output_path else None
+        self.part_size = part_size
+        self.success_topic = success_topic
+        self.error_topic = error_topic
+        # no total timeout, a reasoning generation can run for a long time
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_read=read_timeout)
+        self.history = history
+        self.jobs = OrderedDict()
+        self.stats = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0}
+        self._s3 = None
+        self._sns = None
+        self._tasks = []
+
+    @classmethod
+    def from_env(cls, base_url: str):
+        # ENGINE_SLOTS should match llama-server --parallel
+        slots = int(os.environ.get("ENGINE_SLOTS", 2))
+        return cls(
+            base_url,
+            slots=slots,
+            max_concurrency=int(os.environ.get("ASYNC_MAX_CONCURRENCY", max(1, slots - 1))),
+            queue_size=int(os.environ.get("ASYNC_QUEUE_SIZE", 64)),
+            output_path=os.environ.get("ASYNC_OUTPUT_PATH"),
+            part_size=int(float(os.environ.get("ASYNC_PART_SIZE_MB", 8)) * 1024 * 1024),
+            success_topic=os.environ.get("ASYNC_SUCCESS_TOPIC"),
+            error_topic=os.environ.get("ASYNC_ERROR_TOPIC"),
+            read_timeout=float(os.environ.get("ASYNC_READ_TIMEOUT", 600)),
+        )
+
+    @property
+    def s3(self):
+        if self._s3 is None:
+            self._s3 = boto3.client("s3")
+        return self._s3
+
+    @property
+    def sns(self):
+        if self._sns is None:
+            self._sns = boto3.client("sns")
+        return self._sns
+
+    def submit(self, spec: dict, job_id: str = None):
+        """Queue a job; raises ValueError for a bad spec and asyncio.QueueFull when the queue is full."""
+        job_id = job_id or uuid.uuid4().hex
+        parse_s3_uri(spec["input_location"])
+        output_location = spec.get("output_location") or self.output_path
+        if not output_location:
+            raise ValueError("output_location is required when ASYNC_OUTPUT_PATH is not set")
+        _, key = parse_s3_uri(output_location, prefix=True)
+        if not key or key.endswith("/") or output_location == self.output_path:
+            output_location = f"{output_location.rstrip('/')}/{output_name(job_id)}"
+        if job_id in self.jobs:
+            raise ValueError(f"Job {job_id} already exists")
+
+        job = {
+            "job_id": job_id,
+            "status": "queued",
+            "input_location": spec["input_location"],
+            "output_location": output_location,
+            "content_type": spec.get("content_type"),
+            "received": time.time(),
+            "started": None,
+            "finished": None,
+            "records": 0,
+            "failed_records": 0,
+            "bytes_written": 0,
+            "failure_reason": None,
+        }
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            raise
+        self.stats["submitted"] += 1
+        self.jobs[job_id] = job
+        while len(self.jobs) > self.history:
+            oldest = next(iter(self.jobs.values()))
+            if oldest["status"] in ("queued", "running"):
+                break
+            self.jobs.popitem(last=False)
+        return job
+
+    async def _records(self, obj: dict, job: dict):
+        body = obj["Body"]
+        content_type = (job["content_type"] or obj.get("ContentType") or "").split(";")[0].strip()
+        try:
+            if content_type in JSONL_TYPES or job["input_location"].endswith((".jsonl", ".jsonlines")):
+                lines = body.iter_lines()
+                index = 0
+                while True:
+                    line = await asyncio.to_thread(next, lines, None)
+                    if line is None:
+                        break
+                    if line.strip():
+                        yield index, line
+                        index += 1
+            else:
+                yield 0, await asyncio.to_thread(body.read)
+        finally:
+            body.close()
+
+    async def _run_record(self, session: aiohttp.ClientSession, out: MultipartWriter, index: int, data: bytes):
+        try:
+            payload = json.loads(data)
+            if not isinstance(payload, dict):
+                raise ValueError("request is not a JSON object")
+        except ValueError as e:
+            await out.write((json.dumps({"index": index, "error": f"Invalid request: {e}"}) + "\n").encode("utf-8"))
+            return False
+
+        chat = "messages" in payload
+        url = f"{self.base_url}/v1/chat/completions" if chat else f"{self.base_url}/v1/completions"
+        writer = RecordWriter(out, index, chat)
+        await writer.start()
+        finish_reason = usage = None
+        try:
+            async with self.gate.background():
+                async with session.post(url, json=dict(payload, stream=True)) as response:
+                    if response.status != 200:
+                        body = (await response.content.read(4096)).decode("utf-8", "replace")
+                        raise ValueError(f"engine returned {response.status}: {body}")
+                    async for line in response.content:
+                        line = line.strip()
+                        if not line.startswith(b"data:"):
+                            continue
+                        line = line[len(b"data:"):].strip()
+                        if line == b"[DONE]":
+                            break
+                        chunk = json.loads(line)
+                        if "error" in chunk:
+                            raise ValueError(f"engine error: {json.dumps(chunk['error'])}")
+                        usage = chunk.get("usage") or usage
+                        for choice in chunk.get("choices") or []:
+                            finish_reason = choice.get("finish_reason") or finish_reason
+                            if chat:
+                                delta = choice.get("delta") or {}
+                                for field in ("reasoning_content", "content"):
+                                    if delta.get(field):
+                                        await writer.delta(field, delta[field])
+                            elif choice.get("text"):
+                                await writer.delta("text", choice["text"])
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            await writer.finish(finish_reason, usage, error=str(e) or type(e).__name__)
+            return False
+        await writer.finish(finish_reason, usage)
+        return True
+
+    async def _run(self, job: dict):
+        job["status"] = "running"
+        job["started"] = time.time()
+        out = None
+        try:
+            in_bucket, in_key = parse_s3_uri(job["input_location"])
+            out_bucket, out_key = parse_s3_uri(job["output_location"])
+            obj = await asyncio.to_thread(self.s3.get_object, Bucket=in_bucket, Key=in_key)
+            out = MultipartWriter(self.s3, out_bucket, out_key, self.part_size)
+            async with aiohttp.ClientSession(timeout=self.timeout) as session:
+                async for index, data in self._records(obj, job):
+                    if not await self._run_record(session, out, index, data):
+                        job["failed_records"] += 1
+                    job["records"] += 1
+                    job["bytes_written"] = out.bytes_written
+            await out.close()
+        except asyncio.CancelledError:
+            if out is not None:
+                await out.abort()
+            await self._finish(job, "proxy shut down before the job finished")
+            raise
+        except Exception as e:
+            if out is not None:
+                await out.abort()
+            await self._finish(job, f"{type(e).__name__}: {e}")
+        else:
+            error = None
+            if job["failed_records"]:
+                error = f"{job['failed_records']} of {job['records']} records failed"
+            await self._finish(job, error)
+
+    async def _finish(self, job: dict, error: str = None):
+        job["finished"] = time.time()
+        job["status"] = "failed" if error else "completed"
+        job["failure_reason"] = error
+        self.stats[job["status"]] += 1
+        print(f"Async job {job['job_id']} {job['status']}: {job['records']} records, "
+              f"{job['bytes_written']} bytes in {job['finished'] - (job['started'] or job['finished']):.1f}s"
+              + (f", {error}" if error else ""))
+        await self._notify(job)
+
+    async def _notify(self, job: dict):
+        target = self.success_topic if job["status"] == "completed" else self.error_topic
+        if not target:
+            return
+        # same fields as the SageMaker asynchronous inference notifications
+        message = {
+            "eventTime": _timestamp(job["finished"]),
+            "receivedTime": _timestamp(job["received"]),
+            "invocationStatus": "Completed" if job["status"] == "completed" else "Failed",
+            "inferenceId": job["job_id"],
+            "requestParameters": {"inputLocation": job["input_location"]},
+            "responseParameters": {"outputLocation": job["output_location"], "contentType": "application/jsonlines"},
+            "records": job["records"],
+            "failedRecords": job["failed_records"],
+        }
+        if job["failure_reason"]:
+            message["failureReason"] = job["failure_reason"]
+        try:
+            if target.startswith(("http://", "https://")):
+                async with aiohttp.ClientSession() as session:
+                    async with session.post(target, json=message) as response:
+                        response.raise_for_status()
+            else:
+                await asyncio.to_thread(self.sns.publish, TopicArn=target, Message=json.dumps(message))
+        except Exception as e:
+            print(f"Error sending notification for job {job['job_id']}: {e}")
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self.queue.task_done()
+
+    def get_stats(self):
+        return dict(self.stats, queued=self.queue.qsize(), queue_size=self.queue.maxsize,
+                    running=sum(job["status"] == "running" for job in self.jobs.values()),
+                    capacity=self.gate.get_stats())
+
+    async def on_startup(self, app):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrency)]
+
+    async def on_cleanup(self, app):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        # jobs still waiting in the queue will not run either
+        while not self.queue.empty():
+            job = self.queue.get_nowait()
+            await self._finish(job, "proxy shut down before the job started")
@@ -0,0 +1,223 @@
+"""Prefix-cache warm-up for the proxy.
+
+The proxy counts the shared part of chat requests (system/developer messages
+and tool schemas) with a bounded Space-Saving heavy-hitters sketch and saves
+the most frequent ones to local disk. After a restart the saved prefixes are
+replayed as `max_tokens=1` requests, so the engine's prefix cache is hot before
+/ping reports ready. Cold and warm latency of the replays are kept as the TTFT
+improvement.
+
+llama-server keeps one cached prompt per slot, so at most `ENGINE_SLOTS` prefixes
+are warmed and the most frequent one is replayed last. Counts decay with a
+half-life (`PREFIX_HALF_LIFE_HOURS`) so prompts that are no longer sent drop out.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+import aiohttp
+
+PREFIX_ROLES = ("system", "developer")
+
+
+class SpaceSaving:
+    """Top-k frequent items in O(capacity) memory (Metwally et al., Space-Saving)."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        # key -> {"count", "error", "value"}
+        self.counters = {}
+
+    def add(self, key: str, value, count: int = 1):
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter["count"] += count
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[key] = {"count": count, "error": 0, "value": value}
+            return
+        # replace the smallest counter; the new item inherits its count as error bound
+        min_key = min(self.counters, key=lambda k: self.counters[k]["count"])
+        min_count = self.counters.pop(min_key)["count"]
+        self.counters[key] = {"count": min_count + count, "error": min_count, "value": value}
+
+    def decay(self, factor: float):
+        for counter in self.counters.values():
+            counter["count"] *= factor
+            counter["error"] *= factor
+
+    def top(self, n: int):
+        items = sorted(self.counters.items(), key=lambda item: item[1]["count"], reverse=True)
+        return items[:n]
+
+
+def extract_prefix(payload: dict):
+    """Return the cacheable prefix of a chat request, or None if it has none."""
+    messages = payload.get("messages")
+    if not isinstance(messages, list):
+        return None
+    prefix_messages = []
+    for message in messages:
+        if not isinstance(message, dict) or message.get("role") not in PREFIX_ROLES:
+            break
+        prefix_messages.append(message)
+    tools = payload.get("tools")
+    if not prefix_messages and not tools:
+        return None
+    prefix = {"messages": prefix_messages}
+    if tools:
+        prefix["tools"] = tools
+    if payload.get("model"):
+        prefix["model"] = payload["model"]
+    return prefix
+
+
+def prefix_key(prefix: dict):
+    return hashlib.sha256(json.dumps(prefix, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class PrefixWarmer:
+    def __init__(self, base_url: str, path: str, capacity: int = 128, warm_top: int = 2,
+                 save_interval: float = 60, warm_timeout: float = 600, slots: int = 2,
+                 half_life: float = 24 * 3600):
+        self.base_url = base_url
+        self.path = path
+        self.sketch = SpaceSaving(capacity)
+        # prefixes beyond the slot count would only evict each other
+        self.warm_top = min(warm_top, slots)
+        self.save_interval = save_interval
+        self.half_life = half_life
+        self.warm_timeout = warm_timeout
+        self.ready = warm_top <= 0
+        self.stats = {
+            "tracked_prefixes": 0,
+            "prefixes_warmed": 0,
+            "warm_seconds": 0.0,
+            "cold_ttft_ms": None,
+            "warm_ttft_ms": None,
+            "ttft_improvement_ms": None,
+        }
+        self._tasks = []
+
+    @classmethod
+    def from_env(cls, base_url: str):
+        # ENGINE_SLOTS should match llama-server --parallel
+        slots = int(os.environ.get("ENGINE_SLOTS", 2))
+        return cls(
+            base_url,
+            os.environ.get("PREFIX_CACHE_PATH", "/temp/prefix_cache/hot_prefixes.json"),
+            capacity=int(os.environ.get("PREFIX_CACHE_CAPACITY", 128)),
+            warm_top=int(os.environ.get("PREFIX_WARM_TOP", slots)),
+            save_interval=float(os.environ.get("PREFIX_SAVE_INTERVAL", 60)),
+            warm_timeout=float(os.environ.get("PREFIX_WARM_TIMEOUT", 600)),
+            slots=slots,
+            half_life=float(os.environ.get("PREFIX_HALF_LIFE_HOURS", 24)) * 3600,
+        )
+
+    def observe(self, payload: dict):
+        prefix = extract_prefix(payload)
+        if prefix is not None:
+            self.sketch.add(prefix_key(prefix), prefix)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            age = max(0.0, time.time() - os.path.getmtime(self.path))
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable prefix cache {self.path}: {e}")
+            return
+        # the counts keep decaying while the endpoint is down
+        factor = self._decay_factor(age)
+        for item in saved:
+            self.sketch.add(item["key"], item["prefix"], item["count"] * factor)
+
+    def _decay_factor(self, seconds: float):
+        return 0.5 ** (seconds / self.half_life) if self.half_life > 0 else 1.0
+
+    def save(self):
+        items = [{"key": key, "count": counter["count"], "prefix": counter["value"]}
+                 for key, counter in self.sketch.top(self.sketch.capacity)]
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(items, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Error saving prefix cache: {e}")
+
+    async def _wait_engine(self, session: aiohttp.ClientSession, deadline: float):
+        while time.time() < deadline:
+            try:
+                async with session.get(f"{self.base_url}/health") as response:
+                    if response.status == 200:
+                        return True
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(2)
+        return False
+
+    async def _replay(self, session: aiohttp.ClientSession, prefix: dict):
+        payload = dict(prefix)
+        payload["messages"] = prefix["messages"] + [{"role": "user", "content": "hi"}]
+        payload.update({"max_tokens": 1, "stream": False, "cache_prompt": True})
+        start = time.perf_counter()
+        async with session.post(f"{self.base_url}/v1/chat/completions", json=payload) as response:
+            await response.read()
+            response.raise_for_status()
+        return (time.perf_counter() - start) * 1000
+
+    async def warm(self):
+        start = time.time()
+        # least frequent first: the prefixes replayed last stay in the slots
+        prefixes = [counter["value"] for _, counter in reversed(self.sketch.top(self.warm_top))]
+        cold, warm = [], []
+        try:
+            async with aiohttp.ClientSession() as session:
+                if prefixes and await self._wait_engine(session, start + self.warm_timeout):
+                    for prefix in prefixes:
+                        if time.time() - start > self.warm_timeout:
+                            break
+                        try:
+                            # the second replay hits the cache the first one filled
+                            cold_ms = await self._replay(session, prefix)
+                            warm_ms = await self._replay(session, prefix)
+                        except aiohttp.ClientError as e:
+                            print(f"Error warming prefix: {e}")
+                            continue
+                        cold.append(cold_ms)
+                        warm.append(warm_ms)
+        finally:
+            self.stats["tracked_prefixes"] = len(self.sketch.counters)
+            self.stats["prefixes_warmed"] = len(warm)
+            self.stats["warm_seconds"] = time.time() - start
+            if warm:
+                self.stats["cold_ttft_ms"] = sum(cold) / len(cold)
+                self.stats["warm_ttft_ms"] = sum(warm) / len(warm)
+                self.stats["ttft_improvement_ms"] = self.stats["cold_ttft_ms"] - self.stats["warm_ttft_ms"]
+            self.ready = True
+            print(f"Prefix cache warm-up done: {json.dumps(self.stats)}")
+
+    async def _save_loop(self):
+        while True:
+            await asyncio.sleep(self.save_interval)
+            self.sketch.decay(self._decay_factor(self.save_interval))
+            self.save()
+
+    def get_stats(self):
+        self.stats["tracked_prefixes"] = len(self.sketch.counters)
+        return dict(self.stats, ready=self.ready)
+
+    async def on_startup(self, app):
+        self.load()
+        self._tasks = [asyncio.create_task(self.warm()), asyncio.create_task(self._save_loop())]
+
+    async def on_cleanup(self, app):
+        for task in self._tasks:
+            task.cancel()
+        self.save()
@@ -1,15 +1,25 @@
+import asyncio
 import json
 
 from aiohttp import web
 import aiohttp
 
+from async_jobs import AsyncJobs, is_job
+from prefix_warmer import PrefixWarmer
+
 base_url = "http://127.0.0.1:8000"
+prefix_warmer = PrefixWarmer.from_env(base_url)
+async_jobs = AsyncJobs.from_env(base_url)
 
 async def chat_completion_handler(request):
     try:
         data = await request.read()
         payload = json.loads(data)
-        async with aiohttp.ClientSession() as session:
+        if is_job(payload):
+            return submit_job(request, payload)
+        prefix_warmer.observe(payload)
+        # 和异步任务共享 llama-server 的 slot，实时请求优先
+        async with async_jobs.gate.realtime(), aiohttp.ClientSession() as session:
             if "messages" in payload:
                 target_url = f"{base_url}/v1/chat/completions"
             else:
@@ -44,6 +54,12 @@ async def chat_completion_handler(request):
         )
 
 async def health_check_handler(request):
+    # 预热完成前不接流量
+    if not prefix_warmer.ready:
+        return web.Response(
+            status=503,
+            text="warming up"
+        )
     target_url = f"{base_url}/health"
     try:
         async with aiohttp.ClientSession() as session:
@@ -62,19 +78,58 @@ async def health_check_handler(request):
                     headers=response.headers
                 )
 
-    except aiohttp.ClientError as e:
+    except aiohttp.ClientError:
+        # llama-server 还在启动中
         return web.Response(
-            status=502,
-            text=f"Proxy Error: {str(e)}"
+            status=503,
+            text="not ready"
         )
 
+async def prefix_cache_handler(request):
+    return web.json_response(prefix_warmer.get_stats())
+
+def submit_job(request, payload):
+    try:
+        job = async_jobs.submit(payload, request.headers.get("X-Amzn-SageMaker-Inference-Id"))
+    except ValueError as e:
+        return web.Response(status=400, text=str(e))
+    except asyncio.QueueFull:
+        return web.Response(status=429, text="async job queue full")
+    return web.json_response(job, status=202)
+
+async def async_invocations_handler(request):
+    try:
+        payload = await request.json()
+    except ValueError:
+        return web.Response(status=400, text="invalid JSON")
+    if not is_job(payload):
+        return web.Response(status=400, text="input_location is required")
+    return submit_job(request, payload)
+
+async def async_job_handler(request):
+    job = async_jobs.jobs.get(request.match_info["job_id"])
+    if job is None:
+        return web.Response(status=404, text="job not found")
+    return web.json_response(job)
+
+async def async_stats_handler(request):
+    return web.json_response(async_jobs.get_stats())
+
 
 app = web.Application()
+app.on_startup.append(prefix_warmer.on_startup)
+app.on_cleanup.append(prefix_warmer.on_cleanup)
+app.on_startup.append(async_jobs.on_startup)
+app.on_cleanup.append(async_jobs.on_cleanup)
 app.router.add_route('post', '/invocations', chat_completion_handler)
 app.router.add_route('post', '/v1/chat/completions', chat_completion_handler)
 app.router.add_route('post', '/v1/completions', chat_completion_handler)
 app.router.add_route('get', '/ping', health_check_handler)
 app.router.add_route('get', '/health', health_check_handler)
+app.router.add_route('get', '/prefix_cache', prefix_cache_handler)
+app.router.add_route('post', '/async/invocations', async_invocations_handler)
+app.router.add_route('get', '/async/jobs', async_stats_handler)
+app.router.add_route('get', '/async/jobs/{job_id:.+}', async_job_handler)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""Incremental model weight fetch used by the serve scripts.
+
+Copies a model from S3 (or a local directory standing in for a bucket) into a
+local directory and keeps a manifest of object keys, sizes and ETags next to the
+weights. On restart only new or changed objects are transferred, large shards are
+fetched as parallel byte ranges and every shard is checked against its ETag.
+
+    python3 weight_fetch.py s3://bucket/models/my-model /temp/model_weight
+    python3 weight_fetch.py /mnt/models/my-model /temp/model_weight
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+MANIFEST_NAME = ".weight_manifest.json"
+MiB = 1024 * 1024
+# SSE-KMS / DSSE-KMS objects have ETags that are not MD5 digests
+KMS_ENCRYPTION = ("aws:kms", "aws:kms:dsse")
+VERIFY_WORKERS = max(1, os.cpu_count() or 1)
+
+
+class LocalSource:
+    """A directory that behaves like an S3 prefix, for tests and pre-mounted volumes."""
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def __str__(self):
+        return self.root
+
+    def list_objects(self):
+        objects = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, self.root).replace(os.sep, "/")
+                if key == MANIFEST_NAME:
+                    continue
+                stat = os.stat(path)
+                # a cheap change marker; the content md5 is only computed for verification
+                objects[key] = {"size": stat.st_size, "etag": f"local-{stat.st_mtime_ns}-{stat.st_size}"}
+        return objects
+
+    def read_range(self, key: str, start: int, end: int, chunk_size: int = 8 * MiB):
+        with open(os.path.join(self.root, key), "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def content_md5(self, key: str):
+        return _file_md5(os.path.join(self.root, key))
+
+    def etag_details(self, key: str, etag: str):
+        return {"part_size": None, "encrypted": False}
+
+
+class S3Source:
+    def __init__(self, uri: str, client=None, max_connections: int = 10):
+        import boto3
+        from botocore.config import Config
+
+        bucket, _, prefix = uri[len("s3://"):].partition("/")
+        self.uri = uri
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/") + "/" if prefix else ""
+        # one pooled connection per download / verify thread, the default pool keeps 10
+        self.client = client or boto3.client("s3", config=Config(max_pool_connections=max_connections))
+
+    def __str__(self):
+        return self.uri
+
+    def list_objects(self):
+        objects = {}
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                key = obj["Key"][len(self.prefix):]
+                if not key or key.endswith("/") or key == MANIFEST_NAME:
+                    continue
+                objects[key] = {"size": obj["Size"], "etag": obj["ETag"].strip('"')}
+        return objects
+
+    def read_range(self, key: str, start: int, end: int, chunk_size: int = 8 * MiB):
+        response = self.client.get_object(
+            Bucket=self.bucket, Key=self.prefix + key, Range=f"bytes={start}-{end - 1}"
+        )
+        yield from response["Body"].iter_chunks(chunk_size)
+
+    def content_md5(self, key: str):
+        return None
+
+    def etag_details(self, key: str, etag: str):
+        """Part size and encryption of an object, needed to recompute its ETag."""
+        multipart = "-" in etag
+        kwargs = {"PartNumber": 1} if multipart else {}
+        head = self.client.head_object(Bucket=self.bucket, Key=self.prefix + key, **kwargs)
+        return {
+            # with PartNumber the content length is the size of the first part
+            "part_size": head["ContentLength"] if multipart else None,
+            "encrypted": head.get("ServerSideEncryption") in KMS_ENCRYPTION or "SSECustomerAlgorithm" in head,
+        }
+
+
+def open_source(location: str, max_connections: int = 10):
+    if location.startswith("s3://"):
+        return S3Source(location, max_connections=max_connections)
+    return LocalSource(location)
+
+
+def _file_md5(path: str, start: int = 0, length: int = None):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            chunk = f.read(8 * MiB if remaining is None else min(8 * MiB, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def _is_md5(digest: str):
+    return len(digest) == 32 and all(c in "0123456789abcdef" for c in digest.lower())
+
+
+def verify_etag(path: str, size: int, etag: str, expected_md5: str = None, part_size: int = None,
+                encrypted: bool = False):
+    """Check a downloaded file against its S3 ETag.
+
+    Returns True/False when the ETag can be checked, None when it cannot: a local
+    stand-in without an md5, an SSE-KMS / SSE-C object whose ETag is not a
+    digest, or a multipart ETag whose part size is unknown.
+    """
+    if os.path.getsize(path) != size:
+        return False
+    if expected_md5 is not None:
+        return _file_md5(path) == expected_md5
+    if encrypted:
+        return None
+
+    digest, _, parts = etag.partition("-")
+    if not _is_md5(digest):
+        return None
+    if not parts:
+        return _file_md5(path) == digest
+
+    # the part size is never guessed, a wrong guess would look like corruption
+    if not part_size or -(-size // part_size) != int(parts):
+        return None
+    combined = hashlib.md5()
+    for start in range(0, size, part_size):
+        combined.update(bytes.fromhex(_file_md5(path, start, part_size)))
+    return combined.hexdigest() == digest
+
+
+class Manifest:
+    """Records what is on local disk. Saved after every finished object so an
+    interrupted fetch resumes where it stopped."""
+
+    def __init__(self, dest_dir: str):
+        self.path = os.path.join(dest_dir, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.data = {"source": None, "objects": {}}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.data = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable manifest {self.path}: {e}")
+
+    @property
+    def objects(self):
+        return self.data["objects"]
+
+    def record(self, key: str, info: dict):
+        with self.lock:
+            self.objects[key] = info
+            self._save()
+
+    def forget(self, key: str):
+        with self.lock:
+            self.objects.pop(key, None)
+            self._save()
+
+    def set_source(self, source: str):
+        with self.lock:
+            self.data["source"] = source
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def plan_fetch(remote: dict, manifest: Manifest, dest_dir: str):
+    """Return the keys whose local copy is missing or differs from the remote listing."""
+    changed = []
+    for key, info in sorted(remote.items()):
+        local = manifest.objects.get(key)
+        path = os.path.join(dest_dir, key)
+        if (
+            local is not None
+            and local["size"] == info["size"]
+            and local["etag"] == info["etag"]
+            and os.path.isfile(path)
+            and os.path.getsize(path) == info["size"]
+        ):
+            continue
+        changed.append(key)
+    return changed
+
+
+def _download_range(source, key: str, part_path: str, start: int, end: int):
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+        offset = start
+        for chunk in source.read_range(key, start, end):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+    finally:
+        os.close(fd)
+    if offset != end:
+        raise IOError(f"short read for {key} bytes {start}-{end}: got {offset - start}")
+
+
+def fetch_weights(
+    source,
+    dest_dir: str,
+    concurrency: int = 32,
+    range_size: int = 64 * MiB,
+    verify: bool = True,
+    delete: bool = False,
+):
+    """Bring dest_dir in sync with source. Returns a summary dict."""
+    start_time = time.time()
+    os.makedirs(dest_dir, exist_ok=True)
+    manifest = Manifest(dest_dir)
+    if manifest.data.get("source") != str(source):
+        manifest.data["objects"] = {}
+    manifest.set_source(str(source))
+
+    remote = source.list_objects()
+    changed = plan_fetch(remote, manifest, dest_dir)
+    bytes_to_fetch = sum(remote[key]["size"] for key in changed)
+    print(f"{len(remote)} objects in {source}, {len(changed)} to fetch ({bytes_to_fetch / MiB:.1f} MiB)")
+
+    if delete:
+        for key in list(manifest.objects):
+            if key not in remote:
+                print(f"Removing {key}, no longer in source")
+                path = os.path.join(dest_dir, key)
+                if os.path.exists(path):
+                    os.remove(path)
+                manifest.forget(key)
+
+    def finalize(key):
+        path = os.path.join(dest_dir, key)
+        info = remote[key]
+        if verify:
+            try:
+                details = source.etag_details(key, info["etag"])
+            except Exception as e:
+                print(f"Cannot read ETag details of {key}: {e}")
+                details = {"part_size": None, "encrypted": True}
+            ok = verify_etag(path + ".part", info["size"], info["etag"], source.content_md5(key), **details)
+            if ok is False:
+                raise IOError("checksum mismatch")
+            if ok is None:
+                print(f"Cannot verify ETag of {key}, size checked only")
+        os.replace(path + ".part", path)
+        manifest.record(key, info)
+
+    # every object is split into byte ranges and all ranges share one pool, so a
+    # single huge shard can use the whole concurrency budget; finished shards are
+    # verified on a second pool while other downloads continue
+    pending = {}
+    futures = {}
+    failed = set()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, \
+            ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as verify_executor:
+        finalizers = {}
+        for key in changed:
+            size = remote[key]["size"]
+            part_path = os.path.join(dest_dir, key) + ".part"
+            os.makedirs(os.path.dirname(part_path), exist_ok=True)
+            manifest.forget(key)
+            with open(part_path, "wb") as f:
+                f.truncate(size)
+            ranges = [(start, min(start + range_size, size)) for start in range(0, size, range_size)]
+            if not ranges:
+                finalizers[verify_executor.submit(finalize, key)] = key
+                continue
+            pending[key] = len(ranges)
+            for start, end in ranges:
+                futures[executor.submit(_download_range, source, key, part_path, start, end)] = key
+
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                if key not in failed:
+                    print(f"Error fetching {key}: {e}")
+                failed.add(key)
+            pending[key] -= 1
+            if pending[key] == 0 and key not in failed:
+                finalizers[verify_executor.submit(finalize, key)] = key
+
+        for future in as_completed(finalizers):
+            key = finalizers[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error verifying {key}: {e}")
+                failed.add(key)
+
+    for key in failed:
+        part_path = os.path.join(dest_dir, key) + ".part"
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+    elapsed = time.time() - start_time
+    summary = {
+        "objects": len(remote),
+        "fetched": len(changed) - len(failed),
+        "skipped": len(remote) - len(changed),
+        "failed": sorted(failed),
+        "bytes": bytes_to_fetch,
+        "seconds": elapsed,
+    }
+    print(
+        f"Fetched {summary['fetched']} objects ({bytes_to_fetch / MiB:.1f} MiB) in {elapsed:.1f}s, "
+        f"{summary['skipped']} unchanged, {len(failed)} failed"
+    )
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch model weights with a local manifest cache")
+    parser.add_argument("source", help="s3://bucket/prefix or a local directory")
+    parser.add_argument("dest", help="local directory for the weights")
+    parser.add_argument("--concurrency", "-c", type=int, default=int(os.environ.get("WEIGHT_FETCH_CONCURRENCY", 32)),
+                        help="number of parallel range requests")
+    parser.add_argument("--range-size", type=int, default=64,
+                        help="byte range size in MiB for each request")
+    parser.add_argument("--no-verify", action="store_true", help="skip ETag verification")
+    parser.add_argument("--delete", action="store_true", help="remove local objects missing from the source")
+
+    args = parser.parse_args()
+    result = fetch_weights(
+        open_source(args.source, max_connections=args.concurrency + VERIFY_WORKERS),
+        args.dest,
+        concurrency=args.concurrency,
+        range_size=args.range_size * MiB,
+        verify=not args.no_verify,
+        delete=args.delete,
+    )
+    sys.exit(1 if result["failed"] else 0)
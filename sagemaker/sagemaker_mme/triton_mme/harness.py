@@ -0,0 +1,420 @@
+"""Drive the Triton Python backend models in `models/` without a Triton server.
+
+The stand-in `local_backend/triton_python_backend_utils.py` replaces the Triton
+module, and the diffusers pipelines are replaced by either
+
+- `stub`: a pipeline that sleeps `--denoise-ms` and returns noise images, to
+  measure the overhead of `execute` itself (decoding, encoding, batching), or
+- `tiny`: the real diffusers pipeline class loaded from a small checkpoint on CPU
+  (e.g. `--checkpoint hf-internal-testing/tiny-stable-diffusion-torch`).
+
+Benchmark requests/sec and per-stage time (decode, pipeline, encode) across
+batch sizes and input image sizes:
+
+    python harness.py --model sd_depth --batch-sizes 1,4,8 --payload-sizes 256,512,1024
+
+`--loras N` rotates N adapter ids across the requests and reports the LoRA
+cache hit rate and swap time; the stub pipeline simulates `--lora-load-ms` per
+adapter load, and fake adapters of `--lora-mb` are created for it.
+"""
+import argparse
+import base64
+import importlib.util
+import itertools
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import defaultdict
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODELS_DIR = os.path.join(HERE, "models")
+sys.path.insert(0, os.path.join(HERE, "local_backend"))
+
+import triton_python_backend_utils as pb_utils  # noqa: E402
+
+
+def parse_config(path):
+    """Input names and string parameters of a config.pbtxt (enough for the SD models)."""
+    with open(path) as f:
+        text = f.read()
+    inputs_block = re.search(r"input\s*\[(.*?)\n\]", text, re.S)
+    inputs = re.findall(r'name:\s*"(\w+)"', inputs_block.group(1)) if inputs_block else []
+    parameters = {
+        key: {"string_value": value}
+        for key, value in re.findall(r'key:\s*"(\w+)",?\s*value:\s*\{\s*string_value:\s*"([^"]*)"\s*\}', text)
+    }
+    # commented-out lines are ignored, as Triton does
+    decoupled = re.search(r"^[^#\n]*decoupled:\s*true", text, re.M | re.I) is not None
+    return {
+        "name": os.path.basename(os.path.dirname(path)),
+        "input": inputs,
+        "parameters": parameters,
+        "model_transaction_policy": {"decoupled": decoupled},
+    }
+
+
+class Timer:
+    """Accumulates seconds per stage."""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        # stages may run on different threads (stage_pipeline.py)
+        self.lock = threading.Lock()
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.seconds[stage] += elapsed
+        return timed
+
+    def reset(self):
+        self.seconds.clear()
+
+
+class _Anything:
+    """Attribute sink for pipeline members the models only configure (unet, scheduler...)."""
+
+    def __init__(self):
+        self.config = {}
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class StubPipeline:
+    def __init__(self, denoise_ms=0.0, lora_load_ms=0.0):
+        self.denoise_ms = denoise_ms
+        self.lora_load_ms = lora_load_ms
+        self.scheduler = _Anything()
+        self.unet = _Anything()
+        self.adapters = set()
+        self._noise = {}
+
+    def to(self, *args, **kwargs):
+        return self
+
+    def load_lora_weights(self, path, weight_name=None, adapter_name=None, **kwargs):
+        time.sleep(self.lora_load_ms / 1000)
+        self.adapters.add(adapter_name)
+
+    def delete_adapters(self, adapter_names):
+        names = [adapter_names] if isinstance(adapter_names, str) else adapter_names
+        self.adapters.difference_update(names)
+
+    def __getattr__(self, name):
+        # LoRA and other pipeline helpers are no-ops
+        return lambda *args, **kwargs: None
+
+    def __call__(self, prompt=None, image=None, height=None, width=None, num_images_per_prompt=1, **kwargs):
+        time.sleep(self.denoise_ms / 1000)
+        if image is not None and height is None:
+            width, height = image.size
+        size = (width or 512, height or 512)
+        if size not in self._noise:
+            self._noise[size] = np.random.randint(0, 255, (size[1], size[0], 3), dtype=np.uint8)
+        images = [Image.fromarray(self._noise[size]) for _ in range(num_images_per_prompt)]
+        return types.SimpleNamespace(images=images)
+
+
+class CpuPipeline:
+    """Real diffusers pipeline kept on CPU: `.to("cuda")` and xformers calls are ignored."""
+
+    def __init__(self, pipe):
+        self.__dict__["_pipe"] = pipe
+        self.__dict__["unet"] = _Anything() if not hasattr(pipe, "unet") else _CpuModule(pipe.unet)
+
+    def to(self, *args, **kwargs):
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self._pipe, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._pipe, name, value)
+
+    def __call__(self, *args, **kwargs):
+        return self._pipe(*args, **kwargs)
+
+
+class _CpuModule:
+    def __init__(self, module):
+        self._module = module
+
+    def enable_xformers_memory_efficient_attention(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+
+def _cpu_pipeline_class(pipeline_class, checkpoint=None):
+    """Wrap a real diffusers pipeline class so it loads `checkpoint` in float32 on CPU."""
+
+    def load(path, *args, **kwargs):
+        import torch
+
+        kwargs["torch_dtype"] = torch.float32
+        kwargs.pop("use_safetensors", None)
+        return CpuPipeline(pipeline_class.from_pretrained(checkpoint or path, **kwargs))
+
+    return type(pipeline_class.__name__, (), {"from_pretrained": staticmethod(load),
+                                               "from_single_file": staticmethod(load)})
+
+
+def stub_diffusers(denoise_ms=0.0, lora_load_ms=0.0):
+    """A `diffusers` module whose pipeline classes return StubPipeline, diffusers need not be installed."""
+    module = types.ModuleType("diffusers")
+
+    def module_getattr(name):
+        if name.endswith("Scheduler"):
+            return type(name, (), {"from_config": staticmethod(lambda config: _Anything())})
+        if name.endswith("Pipeline"):
+            load = staticmethod(lambda *args, **kwargs: StubPipeline(denoise_ms, lora_load_ms))
+            return type(name, (), {"from_pretrained": load, "from_single_file": load})
+        raise AttributeError(name)
+
+    module.__getattr__ = module_getattr
+    return module
+
+
+def load_model(model_name, mode="stub", denoise_ms=0.0, checkpoint=None, params=None, lora_load_ms=0.0):
+    """Import models/<name>/1/model.py against the stand-ins and run initialize()."""
+    model_dir = os.path.join(MODELS_DIR, model_name)
+    version_dir = os.path.join(model_dir, "1")
+    config = parse_config(os.path.join(model_dir, "config.pbtxt"))
+    for key, value in (params or {}).items():
+        config["parameters"][key] = {"string_value": value}
+
+    sys.modules["triton_python_backend_utils"] = pb_utils
+    if mode == "stub":
+        sys.modules["diffusers"] = stub_diffusers(denoise_ms, lora_load_ms)
+    # Triton puts the version directory on sys.path, so helpers next to model.py import
+    sys.path.insert(0, version_dir)
+    for helper in ("lora_cache", "stage_pipeline"):
+        sys.modules.pop(helper, None)
+    try:
+        spec = importlib.util.spec_from_file_location(f"{model_name}_model", os.path.join(version_dir, "model.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(version_dir)
+    if mode == "tiny":
+        for name, value in list(vars(module).items()):
+            if name.endswith("Pipeline") and isinstance(value, type):
+                setattr(module, name, _cpu_pipeline_class(value, checkpoint))
+
+    model = module.TritonPythonModel()
+    model.initialize({
+        "model_repository": model_dir,
+        "model_version": "1",
+        "model_config": json.dumps(config),
+        "model_name": model_name,
+    })
+    return module, model, config
+
+
+def encode_test_image(size, seed=0):
+    rng = np.random.default_rng(seed)
+    buffer = BytesIO()
+    Image.fromarray(rng.integers(0, 255, (size, size, 3), dtype=np.uint8)).save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("utf8")
+
+
+def make_request(config, payload_size=512, steps=10, lora=None):
+    values = {
+        "prompt": "a photo of an astronaut riding a horse on mars",
+        "negative_prompt": "blurry",
+        "image": encode_test_image(payload_size),
+        "mask_image": encode_test_image(payload_size, seed=1),
+    }
+    gen_args = {"num_inference_steps": steps}
+    if lora:
+        gen_args["lora"] = lora
+    values["gen_args"] = json.dumps(gen_args)
+    inputs = [
+        pb_utils.Tensor(name, np.array([[values[name].encode("utf-8")]], dtype=object))
+        for name in config["input"]
+        if name in values
+    ]
+    return pb_utils.InferenceRequest(inputs, ["generated_image"], model_name=config["name"])
+
+
+def instrument(module, model, timer):
+    """Time the decode / pipeline / encode stages of a loaded model."""
+    stages = getattr(model, "stages", None)
+    if stages is not None:
+        # preprocess decodes the pixels; decode_image alone is lazy (Image.open)
+        stages.preprocess = timer.wrap("decode", stages.preprocess)
+    elif hasattr(module, "decode_image"):
+        decode_image = module.decode_image
+
+        def decode_and_load(*args, **kwargs):
+            image = decode_image(*args, **kwargs)
+            image.load()
+            return image
+        module.decode_image = timer.wrap("decode", decode_and_load)
+    module.encode_images = timer.wrap("encode", module.encode_images)
+    pipe = model.pipe
+    model.pipe = _TimedPipeline(pipe, timer)
+
+
+class _TimedPipeline:
+    def __init__(self, pipe, timer):
+        self.__dict__["_pipe"] = pipe
+        self.__dict__["_call"] = timer.wrap("pipeline", pipe.__call__)
+
+    def __call__(self, *args, **kwargs):
+        return self._call(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._pipe, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._pipe, name, value)
+
+
+def run_batch(model, requests):
+    responses = model.execute(requests)
+    if responses is None:
+        # decoupled models send through the response sender instead
+        responses = [request.response_sender_calls[0][0] for request in requests]
+    for response in responses:
+        if response.has_error():
+            raise RuntimeError(response.error().message())
+    return responses
+
+
+def fake_loras(count, size_mb):
+    """Sparse `lora_<i>.safetensors` files for the stub pipeline; only their size is read."""
+    lora_dir = tempfile.mkdtemp(prefix="harness_loras_")
+    for i in range(count):
+        with open(os.path.join(lora_dir, f"lora_{i}.safetensors"), "wb") as f:
+            f.truncate(int(size_mb * 1024 * 1024))
+    return lora_dir
+
+
+def benchmark(model_name, batch_sizes, payload_sizes, iterations=5, steps=10, mode="stub",
+              denoise_ms=0.0, checkpoint=None, params=None, loras=0, lora_load_ms=0.0, lora_mb=150):
+    module, model, config = load_model(model_name, mode, denoise_ms, checkpoint, params, lora_load_ms)
+    stages = getattr(model, "stages", None)
+    lora_cache = getattr(model, "lora_cache", None) if loras else None
+    if lora_cache is not None and mode == "stub":
+        lora_cache.lora_dir = fake_loras(loras, lora_mb)
+    # adapter ids rotate across consecutive requests, as with mixed traffic
+    lora_ids = (f"lora_{i % loras}" if loras else None for i in itertools.count())
+    timer = Timer()
+    instrument(module, model, timer)
+    takes_image = "image" in config["input"]
+    payload_sizes = payload_sizes if takes_image else payload_sizes[:1]
+
+    results = []
+    for payload_size in payload_sizes:
+        for batch_size in batch_sizes:
+            requests = [make_request(config, payload_size, steps, next(lora_ids)) for _ in range(batch_size)]
+            run_batch(model, requests)  # warm-up
+            batches = [[make_request(config, payload_size, steps, next(lora_ids)) for _ in range(batch_size)]
+                       for _ in range(iterations)]
+            timer.reset()
+            if stages is not None:
+                stages.reset_stats()
+            if lora_cache is not None:
+                lora_cache.reset_stats()
+            start = time.perf_counter()
+            for batch in batches:
+                run_batch(model, batch)
+            elapsed = time.perf_counter() - start
+            n = iterations * batch_size
+            per_request = {stage: seconds / n * 1000 for stage, seconds in timer.seconds.items()}
+            # with overlapped stages the sum of the stage times can exceed the wall time
+            per_request["other"] = max(0.0, elapsed / n * 1000 - sum(per_request.values()))
+            results.append({
+                "model": model_name,
+                "payload": payload_size if takes_image else None,
+                "batch": batch_size,
+                "requests_per_sec": n / elapsed,
+                "ms_per_request": per_request,
+                "gpu_idle_ms_per_batch": stages.stats()["gpu_idle_ms_per_batch"] if stages is not None else None,
+                "lora_cache": lora_cache.stats() if lora_cache is not None else None,
+            })
+    return results
+
+
+def print_results(results):
+    print(f"{'model':<12} {'payload':>7} {'batch':>5} {'req/s':>8} "
+          f"{'decode':>8} {'pipeline':>9} {'encode':>8} {'other':>8}  (ms/request)  {'GPU idle':>8} (ms/batch)")
+    for r in results:
+        stages = r["ms_per_request"]
+        payload = r["payload"] if r["payload"] is not None else "-"
+        idle = f"{r['gpu_idle_ms_per_batch']:.1f}" if r["gpu_idle_ms_per_batch"] is not None else "-"
+        print(f"{r['model']:<12} {payload:>7} {r['batch']:>5} {r['requests_per_sec']:>8.2f} "
+              f"{stages.get('decode', 0):>8.2f} {stages.get('pipeline', 0):>9.2f} "
+              f"{stages.get('encode', 0):>8.2f} {stages['other']:>8.2f}  {' ' * 12} {idle:>8}")
+
+    lora_results = [r for r in results if r["lora_cache"] is not None]
+    if lora_results:
+        print()
+        print(f"{'model':<12} {'payload':>7} {'batch':>5} {'hit rate':>8} {'misses':>6} "
+              f"{'evictions':>9} {'avg swap (ms)':>13} {'loaded':>6}")
+        for r in lora_results:
+            stats = r["lora_cache"]
+            payload = r["payload"] if r["payload"] is not None else "-"
+            print(f"{r['model']:<12} {payload:>7} {r['batch']:>5} {stats['hit_rate']:>8.2f} {stats['misses']:>6} "
+                  f"{stats['evictions']:>9} {stats['avg_swap_ms']:>13.1f} {stats['loaded']:>6}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Triton Python backend models locally")
+    parser.add_argument("--model", action="append", help="model directory in models/ (default: all SD models)")
+    parser.add_argument("--pipeline", choices=["stub", "tiny"], default="stub")
+    parser.add_argument("--checkpoint", help="checkpoint for --pipeline tiny")
+    parser.add_argument("--denoise-ms", type=float, default=0.0, help="simulated denoise time of the stub pipeline")
+    parser.add_argument("--batch-sizes", default="1,4,8")
+    parser.add_argument("--payload-sizes", default="256,512,1024", help="input image sizes for img2img models")
+    parser.add_argument("--steps", type=int, default=2, help="num_inference_steps sent in gen_args")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--loras", type=int, default=0, help="rotate this many LoRA ids across the requests")
+    parser.add_argument("--lora-load-ms", type=float, default=200.0,
+                        help="simulated adapter load time of the stub pipeline")
+    parser.add_argument("--lora-mb", type=float, default=150.0, help="size of the stub pipeline's fake adapters")
+    parser.add_argument("--param", action="append", default=[], metavar="KEY=VALUE",
+                        help="override a config.pbtxt parameter, e.g. PIPELINE_STAGES=false")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    models = args.model or sorted(
+        name for name in os.listdir(MODELS_DIR) if name.startswith("sd_") or name == "illustrious"
+    )
+    results = []
+    for model_name in models:
+        results += benchmark(
+            model_name,
+            [int(b) for b in args.batch_sizes.split(",")],
+            [int(p) for p in args.payload_sizes.split(",")],
+            iterations=args.iterations,
+            steps=args.steps,
+            mode=args.pipeline,
+            denoise_ms=args.denoise_ms,
+            checkpoint=args.checkpoint,
+            params=dict(param.split("=", 1) for param in args.param),
+            loras=args.loras,
+            lora_load_ms=args.lora_load_ms,
+            lora_mb=args.lora_mb,
+        )
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,147 @@
+"""Local stand-in for Triton's `triton_python_backend_utils`.
+
+Implements the part of the Python backend API used by the models in
+`triton_mme/models` so their `TritonPythonModel` can be driven without a Triton
+server (see harness.py). Only numpy is required.
+"""
+import sys
+
+import numpy as np
+
+
+class TritonError:
+    def __init__(self, message, code=None):
+        self._message = message
+        self._code = code
+
+    def message(self):
+        return self._message
+
+    def code(self):
+        return self._code
+
+
+class TritonModelException(Exception):
+    pass
+
+
+class Tensor:
+    def __init__(self, name, array):
+        self._name = name
+        self._array = np.asarray(array)
+
+    def name(self):
+        return self._name
+
+    def as_numpy(self):
+        return self._array
+
+    def shape(self):
+        return list(self._array.shape)
+
+
+class InferenceRequest:
+    def __init__(self, inputs, requested_output_names=None, model_name=None, request_id=""):
+        self._inputs = list(inputs)
+        self._requested_output_names = requested_output_names or []
+        self._model_name = model_name
+        self._request_id = request_id
+        self.response_sender_calls = []
+
+    def inputs(self):
+        return self._inputs
+
+    def requested_output_names(self):
+        return self._requested_output_names
+
+    def request_id(self):
+        return self._request_id
+
+    def get_response_sender(self):
+        return ResponseSender(self)
+
+
+class InferenceResponse:
+    def __init__(self, output_tensors=None, error=None):
+        self._output_tensors = list(output_tensors or [])
+        self._error = error
+
+    def output_tensors(self):
+        return self._output_tensors
+
+    def has_error(self):
+        return self._error is not None
+
+    def error(self):
+        return self._error
+
+
+TRITONSERVER_RESPONSE_COMPLETE_FINAL = 1
+
+
+class ResponseSender:
+    """Collects responses sent in decoupled mode on the request object."""
+
+    def __init__(self, request):
+        self._request = request
+
+    def send(self, response=None, flags=0):
+        self._request.response_sender_calls.append((response, flags))
+
+
+class Logger:
+    @staticmethod
+    def log_info(message):
+        print(f"[info] {message}", file=sys.stderr)
+
+    @staticmethod
+    def log_warn(message):
+        print(f"[warn] {message}", file=sys.stderr)
+
+    @staticmethod
+    def log_error(message):
+        print(f"[error] {message}", file=sys.stderr)
+
+    @staticmethod
+    def log_verbose(message):
+        pass
+
+    log = log_info
+
+
+def get_input_tensor_by_name(request, name):
+    for tensor in request.inputs():
+        if tensor.name() == name:
+            return tensor
+    return None
+
+
+def get_output_tensor_by_name(response, name):
+    for tensor in response.output_tensors():
+        if tensor.name() == name:
+            return tensor
+    return None
+
+
+def get_output_config_by_name(model_config, name):
+    for output in model_config.get("output", []):
+        if output["name"] == name:
+            return output
+    return None
+
+
+def using_decoupled_model_transaction_policy(model_config):
+    return model_config.get("model_transaction_policy", {}).get("decoupled", False)
+
+
+def triton_string_to_numpy(triton_type):
+    return {
+        "TYPE_BOOL": np.bool_,
+        "TYPE_UINT8": np.uint8,
+        "TYPE_INT32": np.int32,
+        "TYPE_INT64": np.int64,
+        "TYPE_FP16": np.float16,
+        "TYPE_FP32": np.float32,
+        "TYPE_FP64": np.float64,
+        "TYPE_STRING": np.object_,
+    }[triton_type]
@@ -10,6 +10,9 @@ from io import BytesIO
 import base64
 from PIL import Image
 
+from lora_cache import LoraCache, pop_lora_args
+from stage_pipeline import StagedExecutor
+
 def decode_image(img):
     buff = BytesIO(base64.b64decode(img.encode("utf8")))
     image = Image.open(buff)
@@ -40,32 +43,83 @@ class TritonPythonModel:
         
         self.pipe.scheduler = DDIMScheduler.from_config(self.pipe.scheduler.config)
         self.pipe.unet.enable_xformers_memory_efficient_attention()
+
+        model_config = json.loads(args['model_config'])
+        params = model_config.get('parameters', {})
+        lora_cache_mb = int(params.get('LORA_CACHE_MB', {}).get('string_value', 1024))
+        self.lora_cache = LoraCache(self.pipe, f'{self.model_dir}/{self.model_ver}/loras',
+                                    lora_cache_mb * 1024 * 1024, pb_utils.Logger)
+
+        # decode / denoise / encode of consecutive requests overlap, see stage_pipeline.py
+        self.decoupled = pb_utils.using_decoupled_model_transaction_policy(model_config)
+        self.stages = StagedExecutor(
+            self.preprocess, self.denoise, self.postprocess,
+            queue_size=int(params.get('STAGE_QUEUE_SIZE', {}).get('string_value', 2)),
+            overlap=params.get('PIPELINE_STAGES', {}).get('string_value', 'true').lower() == 'true',
+            logger=pb_utils.Logger,
+        )
             
 
     def execute(self, requests):
         
         logger = pb_utils.Logger
-        responses = []
+        batch = []
         for request in requests:
             prompt = pb_utils.get_input_tensor_by_name(request, "prompt").as_numpy().item().decode("utf-8")
             negative_prompt = pb_utils.get_input_tensor_by_name(request, "negative_prompt")
             image = pb_utils.get_input_tensor_by_name(request, "image").as_numpy().item().decode("utf-8")
             gen_args = pb_utils.get_input_tensor_by_name(request, "gen_args")
             
-            image=decode_image(image)
-            
             input_args = dict(prompt=prompt, image=image)
             
             if negative_prompt:
                 input_args["negative_prompt"] = negative_prompt.as_numpy().item().decode("utf-8")
             
+            lora_id, lora_scale = None, 1.0
             if gen_args:
-                gen_args = json.loads(gen_args.as_numpy().item().decode("utf-8"))
+                try:
+                    gen_args = json.loads(gen_args.as_numpy().item().decode("utf-8"))
+                    lora_id, lora_scale = pop_lora_args(gen_args)
+                except ValueError as e:
+                    # fails this request only, the error passes through the stages as its result
+                    batch.append(e)
+                    continue
                 input_args.update(gen_args)            
             
-            images = self.pipe(**input_args).images
-            encoded_images = encode_images(images)
-            
-            responses.append(pb_utils.InferenceResponse([pb_utils.Tensor("generated_image", np.array(encoded_images).astype(object))]))
+            batch.append((lora_id, lora_scale, input_args))
         
-        return responses
+        # requests that share an adapter run back to back so it is swapped in once;
+        # batches of several requests come from dynamic_batching in config.pbtxt
+        order = sorted(range(len(batch)),
+                       key=lambda i: "" if isinstance(batch[i], Exception) else batch[i][0] or "")
+        responses = [None] * len(batch)
+        
+        def on_result(k, result):
+            i = order[k]
+            if isinstance(result, Exception):
+                result = pb_utils.InferenceResponse(error=pb_utils.TritonError(str(result)))
+            responses[i] = result
+            if self.decoupled:
+                # decoupled mode: send each response as soon as it is encoded
+                requests[i].get_response_sender().send(result, flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL)
+        
+        self.stages.run([batch[i] for i in order], on_result)
+        self.lora_cache.log_stats()
+        return None if self.decoupled else responses
+
+    def preprocess(self, item):
+        lora_id, lora_scale, input_args = item
+        for name in ('image',):
+            if name in input_args:
+                input_args[name] = decode_image(input_args[name])
+                input_args[name].load()
+        return item
+    
+    def denoise(self, item):
+        lora_id, lora_scale, input_args = item
+        self.lora_cache.activate(lora_id, lora_scale)
+        return self.pipe(**input_args).images
+    
+    def postprocess(self, images):
+        encoded_images = encode_images(images)
+        return pb_utils.InferenceResponse([pb_utils.Tensor("generated_image", np.array(encoded_images).astype(object))])
@@ -0,0 +1,132 @@
+import queue
+import threading
+import time
+
+
+class StagedExecutor:
+    """Runs a batch through preprocess -> run -> postprocess with the stages overlapped.
+
+    `preprocess` (e.g. image decoding) and `postprocess` (JPEG encoding, building
+    the response) run on their own threads, connected to the `run` stage (the
+    diffusion pipeline, on the calling thread) by bounded queues. While item k is
+    denoising, item k+1 is decoded and item k-1 encoded. Results keep the input
+    order; an exception in any stage becomes that item's result.
+
+    The time the `run` stage spends waiting between items is reported as GPU idle
+    time. With `overlap=False` the stages run back to back for comparison.
+    """
+
+    def __init__(self, preprocess, run, postprocess, queue_size=2, overlap=True, logger=None):
+        self.preprocess = preprocess
+        self.run_stage = run
+        self.postprocess = postprocess
+        self.queue_size = queue_size
+        self.overlap = overlap
+        self.logger = logger
+        self.batches = 0
+        self.wall_seconds = 0.0
+        self.busy_seconds = 0.0
+
+    def _call(self, fn, value):
+        if isinstance(value, Exception):
+            return value
+        try:
+            return fn(value)
+        except Exception as e:
+            return e
+
+    def _deliver(self, on_result, i, result):
+        # a failing callback (e.g. send() in decoupled mode) must not stop the
+        # post stage, the run stage would then block on a full queue
+        try:
+            on_result(i, result)
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.log_error(f"Delivering result {i} failed: {e}")
+            else:
+                print(f"Delivering result {i} failed: {e}")
+
+    def _run_sequential(self, items, on_result):
+        busy = 0.0
+        for i, item in enumerate(items):
+            value = self._call(self.preprocess, item)
+            start = time.perf_counter()
+            value = self._call(self.run_stage, value)
+            busy += time.perf_counter() - start
+            self._deliver(on_result, i, self._call(self.postprocess, value))
+        return busy
+
+    def _run_overlapped(self, items, on_result):
+        pre_queue = queue.Queue(self.queue_size)
+        post_queue = queue.Queue(self.queue_size)
+
+        def pre_worker():
+            for i, item in enumerate(items):
+                pre_queue.put((i, self._call(self.preprocess, item)))
+
+        def post_worker():
+            while True:
+                entry = post_queue.get()
+                if entry is None:
+                    return
+                i, value = entry
+                self._deliver(on_result, i, self._call(self.postprocess, value))
+
+        pre_thread = threading.Thread(target=pre_worker, daemon=True)
+        post_thread = threading.Thread(target=post_worker, daemon=True)
+        pre_thread.start()
+        post_thread.start()
+
+        busy = 0.0
+        try:
+            for _ in range(len(items)):
+                i, value = pre_queue.get()
+                start = time.perf_counter()
+                value = self._call(self.run_stage, value)
+                busy += time.perf_counter() - start
+                post_queue.put((i, value))
+        finally:
+            post_queue.put(None)
+            post_thread.join()
+            pre_thread.join()
+        return busy
+
+    def run(self, items, on_result=None):
+        """Process `items`; returns the results in order and calls on_result(i, result) as each finishes."""
+        results = [None] * len(items)
+
+        def collect(i, result):
+            results[i] = result
+            if on_result is not None:
+                on_result(i, result)
+
+        start = time.perf_counter()
+        if self.overlap and len(items) > 0:
+            busy = self._run_overlapped(items, collect)
+        else:
+            busy = self._run_sequential(items, collect)
+        wall = time.perf_counter() - start
+
+        self.batches += 1
+        self.wall_seconds += wall
+        self.busy_seconds += busy
+        if self.logger is not None and items:
+            idle = wall - busy
+            self.logger.log_info(
+                f"batch of {len(items)}: GPU stage busy {busy * 1000:.1f} ms, "
+                f"idle {idle * 1000:.1f} ms ({idle / wall:.0%} of {wall * 1000:.1f} ms)"
+            )
+        return results
+
+    def stats(self):
+        idle = self.wall_seconds - self.busy_seconds
+        return {
+            "batches": self.batches,
+            "gpu_idle_ms_per_batch": idle / self.batches * 1000 if self.batches else 0.0,
+            "gpu_idle_fraction": idle / self.wall_seconds if self.wall_seconds else 0.0,
+        }
+
+    def reset_stats(self):
+        self.batches = 0
+        self.wall_seconds = 0.0
+        self.busy_seconds = 0.0
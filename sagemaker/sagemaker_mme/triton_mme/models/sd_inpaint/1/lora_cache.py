@@ -0,0 +1,162 @@
+import math
+import os
+import re
+import time
+from collections import OrderedDict
+
+
+LORA_ID = re.compile(r"^\w[\w.-]*$")
+
+
+def pop_lora_args(gen_args):
+    """Remove the LoRA fields from gen_args, they are not pipeline arguments.
+
+    Raises ValueError for an invalid id or scale.
+    """
+    if not isinstance(gen_args, dict):
+        raise ValueError("gen_args must be a JSON object")
+    lora_id = gen_args.pop("lora", None)
+    if lora_id is not None and not (isinstance(lora_id, str) and LORA_ID.match(lora_id)):
+        raise ValueError(f"Invalid lora id {lora_id!r}")
+    raw_scale = gen_args.pop("lora_scale", 1.0)
+    try:
+        lora_scale = float(raw_scale)
+    except (TypeError, ValueError):
+        lora_scale = math.nan
+    if not math.isfinite(lora_scale):
+        raise ValueError(f"Invalid lora_scale {raw_scale!r}")
+    return lora_id, lora_scale
+
+
+class LoraCache:
+    """LRU pool of LoRA adapters loaded into a diffusers pipeline.
+
+    Adapters are read on demand from `lora_dir` (`<id>.safetensors` or a `<id>/`
+    directory in diffusers format) and kept loaded until the total size of the
+    loaded adapters exceeds `max_bytes`, then the least recently used one is
+    deleted from the pipeline.
+    """
+
+    def __init__(self, pipe, lora_dir, max_bytes, logger=None):
+        self.pipe = pipe
+        self.lora_dir = lora_dir
+        self.max_bytes = max_bytes
+        self.logger = logger
+        self.loaded = OrderedDict()  # lora id -> (adapter name, size in bytes)
+        self.active = None
+        self.adapters_loaded = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.swap_seconds = 0.0
+        self.swaps = 0
+
+    def _log(self, message):
+        if self.logger is not None:
+            self.logger.log_info(message)
+        else:
+            print(message)
+
+    def _resolve(self, lora_id):
+        if not LORA_ID.match(lora_id):
+            raise ValueError(f"Invalid lora id {lora_id!r}")
+        for path in (os.path.join(self.lora_dir, f"{lora_id}.safetensors"), os.path.join(self.lora_dir, lora_id)):
+            if os.path.exists(path):
+                return path
+        raise ValueError(f"LoRA {lora_id!r} not found in {self.lora_dir}")
+
+    @staticmethod
+    def _size(path):
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        return sum(
+            os.path.getsize(os.path.join(dirpath, name))
+            for dirpath, _, names in os.walk(path)
+            for name in names
+            if name.endswith((".safetensors", ".bin"))
+        )
+
+    def _loaded_bytes(self):
+        return sum(size for _, size in self.loaded.values())
+
+    def _evict(self, needed):
+        while self.loaded and self._loaded_bytes() + needed > self.max_bytes:
+            lora_id, (name, _) = self.loaded.popitem(last=False)
+            self.pipe.delete_adapters(name)
+            self.evictions += 1
+            self._log(f"Evicted LoRA {lora_id}")
+
+    def activate(self, lora_id, scale=1.0):
+        """Make `lora_id` the only active adapter, or run the base model when it is None."""
+        if lora_id is None:
+            if self.active is not None:
+                self.pipe.disable_lora()
+                self.active = None
+            return
+
+        start = time.time()
+        if lora_id in self.loaded:
+            self.hits += 1
+            self.loaded.move_to_end(lora_id)
+            name, _ = self.loaded[lora_id]
+        else:
+            self.misses += 1
+            path = self._resolve(lora_id)
+            size = self._size(path)
+            self._evict(size)
+            # adapter names end up in module names: identifier-like and unique per
+            # load, so ids such as "style.v1" and "style-v1" never share an adapter
+            self.adapters_loaded += 1
+            name = f"lora_{self.adapters_loaded}"
+            try:
+                if os.path.isfile(path):
+                    self.pipe.load_lora_weights(os.path.dirname(path), weight_name=os.path.basename(path),
+                                                adapter_name=name)
+                else:
+                    self.pipe.load_lora_weights(path, adapter_name=name)
+            except Exception:
+                # a load that fails halfway leaves injected layers behind, and
+                # the adapter is not in self.loaded, so eviction would never free it
+                try:
+                    self.pipe.delete_adapters(name)
+                except Exception as e:
+                    self._log(f"Cleaning up LoRA {lora_id} after a failed load: {e}")
+                raise
+            self.loaded[lora_id] = (name, size)
+
+        if self.active is None:
+            self.pipe.enable_lora()
+        self.pipe.set_adapters([name], adapter_weights=[scale])
+        self.active = name
+
+        elapsed = time.time() - start
+        self.swaps += 1
+        self.swap_seconds += elapsed
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "loaded": len(self.loaded),
+            "loaded_mb": self._loaded_bytes() / 1024 / 1024,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "avg_swap_ms": self.swap_seconds / self.swaps * 1000 if self.swaps else 0.0,
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.swap_seconds = 0.0
+        self.swaps = 0
+
+    def log_stats(self):
+        if self.swaps:
+            stats = self.stats()
+            self._log(
+                f"LoRA cache: {stats['loaded']} loaded ({stats['loaded_mb']:.1f} MB), "
+                f"hit rate {stats['hit_rate']:.2f}, avg swap {stats['avg_swap_ms']:.1f} ms, "
+                f"{stats['evictions']} evictions"
+            )
@@ -1,20 +1,292 @@
-from huggingface_hub import snapshot_download
-from pathlib import Path
+from huggingface_hub import snapshot_download, list_repo_files
+from pathlib import Path, PurePosixPath
+import argparse
+import hashlib
+import json
+import re
 import shutil
+import subprocess
+import sys
+import tempfile
+import time
 
 
-def download_model(model_name, local_model_path):
+MANIFEST_NAME = "model_manifest.json"
+
+# pickle checkpoint prefix -> safetensors prefix expected by diffusers / transformers
+SAFETENSORS_PREFIXES = {
+    "diffusion_pytorch_model": "diffusion_pytorch_model",
+    "pytorch_model": "model",
+}
+WEIGHT_SUFFIXES = (".safetensors", ".bin", ".ckpt", ".pt", ".pth")
+# <prefix>[.<variant>][-00001-of-00002].<bin|safetensors> and <weights>.index[.<variant>].json
+WEIGHT_NAME = re.compile(r"^([^.-]+)(?:\.([^.-]+))?(-\d+-of-\d+)?\.(bin|safetensors)$")
+INDEX_NAME = re.compile(r"^(.+\.(bin|safetensors))\.index(?:\.([^.]+))?\.json$")
+
+
+def _sha256(path, chunk_size=16 * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _safetensors_name(bin_path):
+    """pytorch_model[.variant][-0000i-of-0000n].bin -> model[.variant][-0000i-of-0000n].safetensors"""
+    match = WEIGHT_NAME.match(bin_path.name)
+    if match is None:
+        return bin_path.with_name(bin_path.stem + ".safetensors")
+    prefix, variant, shard, _ = match.groups()
+    name = SAFETENSORS_PREFIXES.get(prefix, prefix) + (f".{variant}" if variant else "") + (shard or "")
+    return bin_path.with_name(name + ".safetensors")
+
+
+def _variant(name):
+    match = WEIGHT_NAME.match(name)
+    if match is not None:
+        return match.group(2)
+    match = INDEX_NAME.match(name)
+    return match.group(3) if match is not None else None
+
+
+def _is_index(name, suffix):
+    match = INDEX_NAME.match(name)
+    return match is not None and match.group(2) == suffix
+
+
+def select_repo_files(repo_files):
+    """Split repo files into (kept, skipped), choosing the weight format per file.
+
+    X.bin is skipped when the same folder has its safetensors counterpart, or
+    when the folder has sharded safetensors of the same variant. Components
+    that only ship .bin keep them (they are converted after the download). Single-file
+    checkpoints at the top level (e.g. *-ema.safetensors) are not part of the
+    diffusers layout and are skipped.
+    """
+    repo_files = set(repo_files)
+    kept, skipped = [], []
+    for name in sorted(repo_files):
+        path = PurePosixPath(name)
+        folder = path.parent
+        if name.endswith(".ckpt") or (str(folder) == "." and name.endswith(WEIGHT_SUFFIXES)):
+            skipped.append(name)
+            continue
+        if name.endswith(".bin") or _is_index(path.name, "bin"):
+            variant = _variant(path.name)
+            sharded_safetensors = any(
+                PurePosixPath(other).parent == folder and _is_index(PurePosixPath(other).name, "safetensors")
+                and _variant(PurePosixPath(other).name) == variant
+                for other in repo_files
+            )
+            counterpart = name.endswith(".bin") and str(folder / _safetensors_name(path).name) in repo_files
+            if sharded_safetensors or counterpart:
+                skipped.append(name)
+                continue
+        kept.append(name)
+    return kept, skipped
+
+
+def convert_bin_to_safetensors(bin_path):
+    """Convert one pickle checkpoint to safetensors and remove the .bin file."""
+    import torch
+    from safetensors.torch import save_file
+
+    bin_path = Path(bin_path)
+    state_dict = torch.load(bin_path, map_location="cpu", weights_only=True)
+
+    # safetensors refuses tensors that share storage (e.g. tied embeddings)
+    seen = set()
+    tensors = {}
+    for name, tensor in state_dict.items():
+        tensor = tensor.contiguous()
+        ptr = tensor.untyped_storage().data_ptr()
+        if ptr in seen:
+            tensor = tensor.clone()
+        seen.add(ptr)
+        tensors[name] = tensor
+
+    target = _safetensors_name(bin_path)
+    save_file(tensors, str(target), metadata={"format": "pt"})
+    bin_path.unlink()
+    return target
+
+
+def convert_bin_index(index_path):
+    """Rewrite a sharded *.bin.index[.variant].json for the converted safetensors shards."""
+    index_path = Path(index_path)
+    index = json.loads(index_path.read_text())
+    index["weight_map"] = {
+        tensor: _safetensors_name(Path(shard)).name for tensor, shard in index["weight_map"].items()
+    }
+    bin_name, _, variant = INDEX_NAME.match(index_path.name).groups()
+    target = index_path.with_name(_safetensors_name(Path(bin_name)).name + ".index"
+                                  + (f".{variant}" if variant else "") + ".json")
+    target.write_text(json.dumps(index, indent=2))
+    index_path.unlink()
+    return target
+
+
+def _build_manifest(local_model_path, model_name, revision):
+    files = {}
+    for path in sorted(local_model_path.rglob("*")):
+        if not path.is_file() or path.name == MANIFEST_NAME:
+            continue
+        stat = path.stat()
+        files[str(path.relative_to(local_model_path))] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": _sha256(path),
+        }
+    return {"model_name": model_name, "revision": revision, "files": files}
+
+
+def verify_manifest(local_model_path, model_name=None, revision=None, check_hash=False):
+    """Return True when local_model_path matches the manifest written by download_model.
+
+    Files are compared by size and mtime, which only needs a stat per file;
+    check_hash re-reads every file and compares its sha256 instead.
+    """
     local_model_path = Path(local_model_path)
-    local_model_path.mkdir(exist_ok=True)
+    manifest_path = local_model_path / MANIFEST_NAME
+    if not manifest_path.exists():
+        return False
+
+    manifest = json.loads(manifest_path.read_text())
+    if model_name is not None and manifest.get("model_name") != model_name:
+        return False
+    if revision is not None and manifest.get("revision") != revision:
+        return False
+
+    for rel_path, info in manifest["files"].items():
+        path = local_model_path / rel_path
+        if not path.is_file():
+            return False
+        stat = path.stat()
+        if stat.st_size != info["size"]:
+            return False
+        if check_hash:
+            if _sha256(path) != info["sha256"]:
+                return False
+        elif stat.st_mtime_ns != info.get("mtime_ns"):
+            return False
+    return True
+
+
+def download_model(model_name, local_model_path, revision="fp16", force=False, verify=False):
+    """Download a diffusers model into a checkpoint/ directory laid out for mmap loading.
+
+    safetensors weights are preferred per file; components that only ship .bin files
+    are converted once. Regular files (no symlinks into a hub cache) are written so the
+    loader can memory-map them in place, and a manifest of file sizes and mtimes lets
+    repeat preparations of the same model/revision return immediately. With verify the
+    files are re-hashed against the sha256 checksums in the manifest instead.
+    """
+    local_model_path = Path(local_model_path)
+    local_model_path.mkdir(parents=True, exist_ok=True)
+
+    if not force and verify_manifest(local_model_path, model_name, revision, check_hash=verify):
+        print(f"{local_model_path} already prepared, skipping download")
+        return local_model_path
+
+    _, skipped = select_repo_files(list_repo_files(model_name, revision=revision))
+    ignore_patterns = ["*.ckpt"] + skipped
+
     local_cache_path = Path("./tmp_cache")
     snapshot_download(
         repo_id=model_name,
         local_dir_use_symlinks=False,
-        revision="fp16",
+        revision=revision,
         cache_dir=local_cache_path,
         local_dir=local_model_path,
-        ignore_patterns=["*.ckpt", "*.safetensors"],
+        ignore_patterns=ignore_patterns,
     )
-    shutil.rmtree(local_cache_path)
+    shutil.rmtree(local_cache_path, ignore_errors=True)
+
+    for bin_path in sorted(local_model_path.rglob("*.bin")):
+        print(f"Converting {bin_path} to safetensors")
+        convert_bin_to_safetensors(bin_path)
+    for index_path in sorted(local_model_path.rglob("*.bin.index*.json")):
+        convert_bin_index(index_path)
+
+    manifest = _build_manifest(local_model_path, model_name, revision)
+    (local_model_path / MANIFEST_NAME).write_text(json.dumps(manifest, indent=2))
+
+    return local_model_path
+
+
+_LOAD_SNIPPET = """
+import sys, time
+import torch
+from safetensors.torch import load_file
+
+def status_kb(field):
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith(field))
+
+with open("/proc/self/clear_refs", "w") as f:
+    f.write("5")  # reset VmHWM so the import peak is not counted
+baseline = status_kb("VmRSS")
+t = time.perf_counter()
+if sys.argv[1].endswith(".safetensors"):
+    state_dict = load_file(sys.argv[1])
+else:
+    state_dict = torch.load(sys.argv[1], map_location="cpu", weights_only=True)
+for tensor in state_dict.values():
+    tensor.sum()
+print(time.perf_counter() - t, status_kb("VmHWM") - baseline)
+"""
+
+
+def _measure_load(path):
+    # a fresh interpreter per load so peak RSS is not polluted by earlier runs;
+    # peak RSS is reported on top of the post-import baseline
+    out = subprocess.run([sys.executable, "-c", _LOAD_SNIPPET, str(path)],
+                         check=True, capture_output=True, text=True).stdout.split()
+    return float(out[0]), int(out[1]) / 1024
+
+
+def benchmark_weight_loading(num_tensors=16, tensor_mb=16):
+    """Compare load time and peak RSS of a small .bin checkpoint against its safetensors copy."""
+    import torch
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bin_path = Path(tmp_dir) / "diffusion_pytorch_model.bin"
+        numel = tensor_mb * 1024 * 1024 // 2
+        torch.save({f"layer_{i}.weight": torch.randn(numel, dtype=torch.float16)
+                    for i in range(num_tensors)}, bin_path)
+        size_mb = bin_path.stat().st_size / 1024 / 1024
+
+        bin_result = _measure_load(bin_path)
+        safetensors_result = _measure_load(convert_bin_to_safetensors(bin_path))
+
+    print(f"checkpoint size: {size_mb:.1f} MB")
+    print(f"{'format':<12} {'load (s)':>10} {'peak RSS (MB)':>14}")
+    for name, (seconds, rss_mb) in (("bin", bin_result), ("safetensors", safetensors_result)):
+        print(f"{name:<12} {seconds:>10.3f} {rss_mb:>14.1f}")
+    return {"bin": bin_result, "safetensors": safetensors_result}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prepare diffusers checkpoints for the Triton MME models")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    download_parser = subparsers.add_parser("download", help="download a model into a checkpoint/ directory")
+    download_parser.add_argument("model_name")
+    download_parser.add_argument("local_model_path")
+    download_parser.add_argument("--revision", default="fp16")
+    download_parser.add_argument("--force", action="store_true", help="ignore an existing manifest")
+    download_parser.add_argument("--verify", action="store_true",
+                                 help="check an existing download by sha256 instead of size and mtime")
+
+    benchmark_parser = subparsers.add_parser("benchmark", help="compare .bin and safetensors loading")
+    benchmark_parser.add_argument("--num-tensors", type=int, default=16)
+    benchmark_parser.add_argument("--tensor-mb", type=int, default=16)
 
-    return local_model_path
\ No newline at end of file
+    args = parser.parse_args()
+    if args.command == "download":
+        start = time.perf_counter()
+        download_model(args.model_name, args.local_model_path, args.revision, args.force, args.verify)
+        print(f"prepared in {time.perf_counter() - start:.1f}s")
+    else:
+        benchmark_weight_loading(args.num_tensors, args.tensor_mb)
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""Container entrypoint that starts the model server and its helpers in parallel.
+
+Replaces the sequential bash logic of `serve`:
+
+- finds the model directory under /opt/ml/model and loads its `.env`
+- fetches the weights (weight_fetch.py, when MODEL_S3_URI is set), starts the
+  proxy, one-shot tasks and sidecars at the same time
+- runs `start.sh` once the weights are in place and waits for the engine to be ready
+- restarts crashed sidecars and the proxy with backoff
+- forwards SIGTERM/SIGINT so the proxy and the engine can drain in-flight requests
+- logs a per-phase startup timeline and writes it as JSON
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Timeline:
+    def __init__(self, path: str):
+        self.path = path
+        self.start = time.time()
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def begin(self, name: str):
+        with self.lock:
+            self.phases[name] = {"start": time.time() - self.start, "end": None}
+        print(f"[startup] +{self.phases[name]['start']:.1f}s {name} started", flush=True)
+
+    def end(self, name: str, status: str = "ok"):
+        with self.lock:
+            phase = self.phases[name]
+            phase["end"] = time.time() - self.start
+            phase["status"] = status
+            phase["seconds"] = phase["end"] - phase["start"]
+            self._save()
+        print(f"[startup] +{phase['end']:.1f}s {name} {status} ({phase['seconds']:.1f}s)", flush=True)
+
+    def summary(self):
+        print("[startup] timeline:", flush=True)
+        for name, phase in sorted(self.phases.items(), key=lambda item: item[1]["start"]):
+            end = phase["end"]
+            end_str = f"{end:7.1f}s" if end is not None else "    ..."
+            seconds = f"{phase['seconds']:.1f}s" if end is not None else "running"
+            print(f"[startup]   {name:<16} {phase['start']:7.1f}s -> {end_str}  {seconds}", flush=True)
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "w") as f:
+                json.dump(self.phases, f, indent=2)
+        except OSError as e:
+            print(f"Error writing startup timeline: {e}", flush=True)
+
+
+class Process:
+    """A shell command in its own process group, optionally restarted when it exits."""
+
+    def __init__(self, name: str, command: str, env: dict, cwd: str = None, restart: bool = False):
+        self.name = name
+        self.command = command
+        self.env = env
+        self.cwd = cwd
+        self.restart = restart
+        self.popen = None
+        self.restarts = 0
+        self.backoff = 1
+        self.next_start = 0
+
+    def start(self):
+        print(f"Starting {self.name}: {self.command}", flush=True)
+        self.popen = subprocess.Popen(
+            ["/bin/bash", "-c", self.command], env=self.env, cwd=self.cwd, start_new_session=True
+        )
+        self.started_at = time.time()
+
+    def poll(self):
+        return None if self.popen is None else self.popen.poll()
+
+    def check(self, stopping: bool):
+        """Restart the process with exponential backoff if it died."""
+        if not self.restart or stopping or self.popen is None:
+            return
+        code = self.popen.poll()
+        if code is None:
+            # reset the backoff once the process has stayed up for a while
+            if time.time() - self.started_at > 60:
+                self.backoff = 1
+            return
+        now = time.time()
+        if not self.next_start:
+            print(f"{self.name} exited with code {code}, restarting in {self.backoff}s", flush=True)
+            self.next_start = now + self.backoff
+            self.backoff = min(self.backoff * 2, 60)
+        elif now >= self.next_start:
+            self.next_start = 0
+            self.restarts += 1
+            self.start()
+
+    def signal(self, sig):
+        if self.popen is not None and self.popen.poll() is None:
+            try:
+                os.killpg(self.popen.pid, sig)
+            except ProcessLookupError:
+                pass
+
+
+def find_model_dir(base_dir: str):
+    if not os.path.isdir(base_dir):
+        print(f"Error: {base_dir} directory does not exist", flush=True)
+        sys.exit(1)
+    subdirs = sorted(
+        entry.path for entry in os.scandir(base_dir) if entry.is_dir() and not entry.name.startswith(".")
+    )
+    if not subdirs:
+        print("No subdirectory found", flush=True)
+        sys.exit(0)
+    return subdirs[0]
+
+
+def load_env(model_dir: str):
+    """Source `.env` with bash so the same syntax as before keeps working."""
+    env = dict(os.environ)
+    env_file = os.path.join(model_dir, ".env")
+    if not os.path.isfile(env_file):
+        return env
+    output = subprocess.run(
+        ["/bin/bash", "-c", 'set -a; source "$1" >&2; env -0', "_", env_file],
+        env=env, cwd=model_dir, check=True, stdout=subprocess.PIPE,
+    ).stdout
+    for item in output.split(b"\0"):
+        key, sep, value = item.decode("utf-8", "replace").partition("=")
+        if sep:
+            env[key] = value
+    return env
+
+
+def wait_ready(url: str, engine: Process, stop_event: threading.Event, timeout: float):
+    deadline = time.time() + timeout
+    while not stop_event.is_set() and time.time() < deadline:
+        if engine.poll() is not None:
+            return False
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                if response.status == 200:
+                    return True
+        except Exception:
+            pass
+        stop_event.wait(2)
+    return False
+
+
+def wait_listening(url: str, stop_event: threading.Event, timeout: float):
+    """Wait until url answers; any HTTP status counts, /ping returns 503 until the engine is up."""
+    deadline = time.time() + timeout
+    while not stop_event.is_set() and time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=5):
+                return True
+        except urllib.error.HTTPError:
+            return True
+        except Exception:
+            pass
+        stop_event.wait(0.2)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Start the model server, proxy and sidecars in parallel")
+    parser.add_argument("--base-dir", default="/opt/ml/model/")
+    parser.add_argument("--proxy", help="proxy command, restarted if it crashes")
+    parser.add_argument("--proxy-url", default=f"http://127.0.0.1:{os.environ.get('SAGEMAKER_BIND_TO_PORT', 8080)}/ping",
+                        help="proxy URL polled until it answers, which ends the proxy startup phase")
+    parser.add_argument("--sidecar", action="append", default=[], help="long-running helper, restarted if it crashes")
+    parser.add_argument("--task", action="append", default=[], help="one-shot helper run in parallel with startup")
+    parser.add_argument("--ready-url", help="engine URL that returns 200 when it can serve requests")
+    parser.add_argument("--ready-timeout", type=float, default=3600)
+    parser.add_argument("--drain-timeout", type=float, default=float(os.environ.get("DRAIN_TIMEOUT", 60)),
+                        help="seconds to wait for processes to exit after SIGTERM")
+    parser.add_argument("--timeline", default=os.environ.get("STARTUP_TIMELINE_PATH", "/tmp/startup_timeline.json"))
+    args = parser.parse_args()
+
+    timeline = Timeline(args.timeline)
+    stop_event = threading.Event()
+    received = []
+
+    def handle_signal(signum, frame):
+        received.append(signum)
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    timeline.begin("discover")
+    model_dir = find_model_dir(args.base_dir)
+    print("Found model directory", model_dir, flush=True)
+    env = load_env(model_dir)
+    timeline.end("discover")
+
+    sidecars = []
+    if args.proxy:
+        timeline.begin("proxy")
+        proxy = Process("proxy", args.proxy, env, restart=True)
+        proxy.start()
+        sidecars.append(proxy)
+
+        def wait_proxy():
+            listening = wait_listening(args.proxy_url, stop_event, args.ready_timeout)
+            timeline.end("proxy", "listening" if listening else "not listening")
+
+        threading.Thread(target=wait_proxy, daemon=True).start()
+    for i, command in enumerate(args.sidecar):
+        sidecar = Process(f"sidecar-{i}", command, env, restart=True)
+        sidecar.start()
+        sidecars.append(sidecar)
+    tasks = []
+    for i, command in enumerate(args.task):
+        task = Process(f"task-{i}", command, env)
+        timeline.begin(task.name)
+        task.start()
+        tasks.append(task)
+    finished_tasks = set()
+
+    # weights and engine run on a thread so the main loop keeps supervising
+    # sidecars (and handling signals) during a long download
+    engine_script = os.path.join(APP_DIR, "start.sh")
+    engine = Process("engine", engine_script, env, cwd=model_dir)
+    engine_state = {"failed": False}
+
+    def start_engine():
+        if env.get("MODEL_S3_URI"):
+            env.setdefault("MODEL_LOCAL_DIR", "/temp/model_weight")
+            timeline.begin("weights")
+            fetch_script = os.path.join(APP_DIR, "weight_fetch.py")
+            fetch = Process("weights", f'python3 {fetch_script} "$MODEL_S3_URI" "$MODEL_LOCAL_DIR"', env)
+            fetch.start()
+            while fetch.poll() is None and not stop_event.is_set():
+                time.sleep(0.5)
+            if stop_event.is_set():
+                fetch.signal(signal.SIGTERM)
+                timeline.end("weights", "cancelled")
+                return
+            if fetch.poll() != 0:
+                timeline.end("weights", "failed")
+                engine_state["failed"] = True
+                stop_event.set()
+                return
+            timeline.end("weights")
+
+        start_script = os.path.join(model_dir, "start.sh")
+        if not os.path.isfile(start_script):
+            print(f"No start.sh found in {model_dir}", flush=True)
+            engine_state["failed"] = True
+            stop_event.set()
+            return
+        shutil.copy(start_script, engine_script)
+        os.chmod(engine_script, 0o755)
+
+        if stop_event.is_set():
+            return
+        timeline.begin("engine")
+        engine.start()
+        if args.ready_url:
+            ready = wait_ready(args.ready_url, engine, stop_event, args.ready_timeout)
+            timeline.end("engine", "ready" if ready else "not ready")
+        else:
+            timeline.end("engine", "launched")
+        timeline.summary()
+
+    engine_thread = threading.Thread(target=start_engine, daemon=True)
+    engine_thread.start()
+
+    while not stop_event.is_set():
+        code = engine.poll()
+        if code is not None:
+            print(f"Engine exited with code {code}", flush=True)
+            break
+        for sidecar in sidecars:
+            sidecar.check(stopping=False)
+        for task in tasks:
+            if task.poll() is not None and task.name not in finished_tasks:
+                finished_tasks.add(task.name)
+                timeline.end(task.name, f"exit {task.poll()}")
+        stop_event.wait(1)
+
+    if received:
+        print(f"Received signal {received[0]}, draining", flush=True)
+    # the proxy stops taking new requests and finishes the in-flight ones while the
+    # engine is still up, then the engine drains, then the helpers are stopped
+    deadline = time.time() + args.drain_timeout
+    proxies = [process for process in sidecars if process.name == "proxy"]
+    helpers = [process for process in sidecars if process.name != "proxy"] + tasks
+    for group in (proxies, [engine], helpers):
+        for process in group:
+            process.signal(signal.SIGTERM)
+        for process in group:
+            while process.poll() is None and time.time() < deadline:
+                time.sleep(0.2)
+            if process.poll() is None:
+                print(f"{process.name} did not exit in {args.drain_timeout}s, killing", flush=True)
+                process.signal(signal.SIGKILL)
+    engine_thread.join(timeout=5)
+
+    if engine_state["failed"]:
+        sys.exit(1)
+    code = engine.poll()
+    sys.exit(0 if received or code is None else code)
+
+
+if __name__ == "__main__":
+    main()